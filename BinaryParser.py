@@ -22,7 +22,9 @@ import struct
 import sys
 from datetime import datetime
 import types
-import cPickle
+import weakref
+import threading
+from collections import OrderedDict
 
 verbose = False
 
@@ -114,6 +116,163 @@ def hex_dump(src, start_addr=0):
     return ''.join(result)
 
 
+class NullLock(object):
+    """
+    A lock that does nothing, for objects that are optionally thread safe.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+NULL_LOCK = NullLock()
+
+
+def parse_size(s):
+    """
+    Parse a number of bytes with an optional K, M, or G suffix,
+      such as "16M", as given on the command line.
+
+    @raise ValueError: if the size is malformed.
+    """
+    s = s.strip()
+    multiplier = SIZE_SUFFIXES.get(s[-1:].upper())
+    if multiplier is None:
+        return int(s)
+    return int(s[:-1]) * multiplier
+
+
+SIZE_SUFFIXES = {
+    "K": 1024,
+    "M": 1024 * 1024,
+    "G": 1024 * 1024 * 1024,
+}
+
+
+class Cache(object):
+    """
+    A LRU cache with a bounded total size.
+
+    The size of each entry is given by `sizeof(value)`. If `sizeof`
+      is None, each entry has size 1, and `size_limit` is a number
+      of entries. The cache counts its hits, misses, and evictions.
+
+    If `threadsafe` is True, then each operation holds a lock.
+      `get_or_load` does not hold the lock while it calls the loader,
+      so loaders may use the cache recursively.
+    """
+    def __init__(self, size_limit, sizeof=None, threadsafe=False):
+        super(Cache, self).__init__()
+        if threadsafe:
+            self._lock = threading.Lock()
+        else:
+            self._lock = NULL_LOCK
+        self._c = OrderedDict()
+        self._size_limit = size_limit
+        self._sizeof = sizeof
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def insert(self, k, v):
+        """
+        add a key and value to the front
+        """
+        if self._sizeof is None:
+            size = 1
+        else:
+            size = self._sizeof(v)
+
+        with self._lock:
+            old = self._c.pop(k, None)
+            if old is not None:
+                self._size -= old[1]
+            self._c[k] = (v, size)
+            self._size += size
+
+            while self._size > self._size_limit and len(self._c) > 1:
+                _, (_, evicted_size) = self._c.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+
+    def exists(self, k):
+        return k in self._c
+
+    def touch(self, k):
+        """
+        bring a key to the front
+        """
+        with self._lock:
+            self._c[k] = self._c.pop(k)
+
+    def get(self, k):
+        """
+        fetch the value of a key, and bring it to the front
+
+        @raise KeyError: if the key is not cached.
+        """
+        with self._lock:
+            try:
+                entry = self._c.pop(k)
+            except KeyError:
+                self.misses += 1
+                raise
+            self._c[k] = entry
+            self.hits += 1
+            return entry[0]
+
+    def get_or_load(self, k, loader):
+        """
+        fetch the value of a key, or if it is not cached, call
+          `loader()` to compute the value and cache it.
+        Exceptions raised by the loader are not cached.
+        """
+        try:
+            return self.get(k)
+        except KeyError:
+            v = loader()
+            self.insert(k, v)
+            return v
+
+    def __len__(self):
+        return len(self._c)
+
+    def size(self):
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._c.clear()
+            self._size = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._c),
+            "size": self._size,
+            "size_limit": self._size_limit,
+        }
+
+    def format_stats(self, name):
+        """
+        Format the counters on one line, for a CLI to print at exit.
+        """
+        lookups = self.hits + self.misses
+        if lookups:
+            rate = 100.0 * self.hits / lookups
+        else:
+            rate = 0.0
+        return "%s cache: %d hits, %d misses (%.1f%% hit rate), " \
+            "%d evictions, %d entries, %d of %d bytes" % \
+            (name, self.hits, self.misses, rate, self.evictions,
+             len(self._c), self._size, self._size_limit)
+
+
 class decoratorargs(object):
     def __new__(typ, *attr_args, **attr_kwargs):
         def decorator(orig_func):
@@ -124,18 +283,25 @@ class decoratorargs(object):
 
 
 class memoize(decoratorargs):
-    class Node:
-        __slots__ = ['key', 'value', 'older', 'newer']
-
-        def __init__(self, key, value, older=None, newer=None):
-            self.key = key
-            self.value = value
-            self.older = older
-            self.newer = newer
-
-    def __init__(self, func, capacity=1000,
-                 keyfunc=lambda *args, **kwargs: cPickle.dumps((args,
-                                                                kwargs))):
+    """
+    Memoize a method, or a property, with a bounded LRU cache
+      per instance.
+
+    Arguments:
+    - `capacity`: The number of results to cache for each instance.
+    - `keyfunc`: A function of the method arguments that returns a
+        hashable cache key. By default, the key is the tuple of
+        arguments, so they must be hashable.
+    - `threadsafe`: If True, the cache of each instance is locked.
+
+    Accessing the method on an instance returns a bound, memoized
+      method with `cache_info()` and `cache_clear()` methods.
+      The caches are held by this descriptor, weakly keyed by instance,
+      rather than in the instance state, so that instances may still
+      be pickled, and copies of an instance get their own caches.
+    A memoized property stores its value in the instance `__dict__`.
+    """
+    def __init__(self, func, capacity=1000, keyfunc=None, threadsafe=False):
         if not isinstance(func, property):
             self.func = func
             self.name = func.__name__
@@ -146,84 +312,66 @@ class memoize(decoratorargs):
             self.is_property = True
         self.capacity = capacity
         self.keyfunc = keyfunc
-        self.reset()
+        self.threadsafe = threadsafe
+        # map from instance to its Cache, which must not refer
+        #  to the instance, or it would never be collected.
+        self._caches = weakref.WeakKeyDictionary()
+        self._caches_lock = threading.Lock()
 
-    def reset(self):
-        self.mru = self.Node(None, None)
-        self.mru.older = self.mru.newer = self.mru
-        self.nodes = {self.mru.key: self.mru}
-        self.count = 1
-        self.hits = 0
-        self.misses = 0
+    def _get_cache(self, inst):
+        try:
+            return self._caches[inst]
+        except KeyError:
+            pass
+        with self._caches_lock:
+            cache = self._caches.get(inst)
+            if cache is None:
+                cache = Cache(self.capacity, threadsafe=self.threadsafe)
+                self._caches[inst] = cache
+            return cache
 
     def __get__(self, inst, clas):
-        self.obj = inst
-        if self.is_property:
-            return self.__call__()
-        else:
+        if inst is None:
             return self
-
-    def __call__(self, *args, **kwargs):
-        key = self.keyfunc(*args, **kwargs)
-        try:
-            node = self.nodes[key]
-        except KeyError:
-            # We have an entry not in the cache
-            self.misses += 1
-            func = types.MethodType(self.func, self.obj, self.name)
-            value = func(*args, **kwargs)
-            lru = self.mru.newer  # Always true
-            # If we haven't reached capacity
-            if self.count < self.capacity:
-                # Put it between the MRU and LRU - it'll be the new MRU
-                node = self.Node(key, value, self.mru, lru)
-                self.mru.newer = node
-
-                lru.older = node
-                self.mru = node
-                self.count += 1
-            else:
-                # It's FULL! We'll make the LRU be the new MRU, but replace its
-                # value first
-                try:
-                    del self.nodes[lru.key]  # This mapping is now invalid
-                except KeyError:  # HACK TODO: this may not work/leak
-                    pass
-                lru.key = key
-                lru.value = value
-                self.mru = lru
-
-            # Add the new mapping
-            self.nodes[key] = self.mru
+        if self.is_property:
+            value = self.func(inst)
+            inst.__dict__[self.name] = value
             return value
+        return MemoizedMethod(self.func, inst, self._get_cache(inst),
+                              self.keyfunc)
 
-        # We have an entry in the cache
-        self.hits += 1
 
-        # If it's already the MRU, do nothing
-        if node is self.mru:
-            return node.value
-
-        lru = self.mru.newer  # Always true
-
-        # If it's the LRU, update the MRU to be it
-        if node is lru:
-            self.mru = lru
-            return node.value
+class MemoizedMethod(object):
+    """
+    A method bound to an instance, with its own cache of results.
+    See `memoize`.
+    """
+    __slots__ = ["_func", "_inst", "_cache", "_keyfunc"]
 
-        # Remove the node from the list
-        node.older.newer = node.newer
-        node.newer.older = node.older
+    def __init__(self, func, inst, cache, keyfunc):
+        self._func = func
+        self._inst = inst
+        self._cache = cache
+        self._keyfunc = keyfunc
 
-        # Put it between MRU and LRU
-        node.older = self.mru
-        self.mru.newer = node
+    def __call__(self, *args, **kwargs):
+        if self._keyfunc is not None:
+            key = self._keyfunc(*args, **kwargs)
+        elif kwargs:
+            key = (args, tuple(sorted(kwargs.iteritems())))
+        else:
+            key = args
+        return self._cache.get_or_load(key,
+                                       lambda: self._func(self._inst, *args, **kwargs))
 
-        node.newer = lru
-        lru.older = node
+    def cache_info(self):
+        """
+        Get the hit, miss, and eviction counts of the cache.
+        """
+        return self._cache.stats()
 
-        self.mru = node
-        return node.value
+    def cache_clear(self):
+        self._cache.clear()
 
 
 def align(offset, alignment):
@@ -283,7 +431,8 @@ class BinaryParserException(Exception):
         Arguments:
         - `value`: A string description.
         """
-        super(BinaryParserException, self).__init__()
+        # pass the value on, so that the exception can be pickled
+        super(BinaryParserException, self).__init__(value)
         self._value = value
 
     def __repr__(self):
@@ -317,6 +466,8 @@ class OverrunBufferException(ParseException):
     def __init__(self, readOffs, bufLen):
         tvalue = "read: %s, buffer length: %s" % (hex(readOffs), hex(bufLen))
         super(ParseException, self).__init__(tvalue)
+        # the arguments with which to recreate the exception when unpickled
+        self.args = (readOffs, bufLen)
 
     def __repr__(self):
         return "OverrunBufferException(%r)" % (self._value)
@@ -326,6 +477,35 @@ class OverrunBufferException(ParseException):
             (self._value)
 
 
+def _unpack_from_method(fmt, buf, offset):
+    return buf.unpack_from(fmt, offset)
+
+
+# the unpack function chosen for each type of buffer
+_UNPACK_FROM_BY_TYPE = {}
+
+
+def get_unpack_from(buf):
+    """
+    Choose the function with the signature of struct.unpack_from that
+      unpacks values from the given buffer. This is struct.unpack_from,
+      unless the buffer provides its own `unpack_from(fmt, offset)`
+      method, such as a FileMap, which unpacks from its cached blocks
+      without a copy. The choice is made once per type of buffer.
+    Arguments:
+    - `buf`: The buffer from which values will be read.
+    """
+    try:
+        return _UNPACK_FROM_BY_TYPE[type(buf)]
+    except KeyError:
+        if hasattr(buf, "unpack_from"):
+            f = _unpack_from_method
+        else:
+            f = struct.unpack_from
+        _UNPACK_FROM_BY_TYPE[type(buf)] = f
+        return f
+
+
 def read_byte(buf, offset):
     """
     Returns a little-endian unsigned byte from the relative offset of the given buffer.
@@ -339,6 +519,9 @@ def read_byte(buf, offset):
         return struct.unpack_from("<B", buf, offset)[0]
     except struct.error:
         raise OverrunBufferException(offset, len(buf))
+    except TypeError:
+        # not a buffer, such as a FileMap
+        return _read_unpackable("<B", buf, offset)
 
 
 def read_word(buf, offset):
@@ -354,6 +537,8 @@ def read_word(buf, offset):
         return struct.unpack_from("<H", buf, offset)[0]
     except struct.error:
         raise OverrunBufferException(offset, len(buf))
+    except TypeError:
+        return _read_unpackable("<H", buf, offset)
 
 
 def read_dword(buf, offset):
@@ -369,6 +554,21 @@ def read_dword(buf, offset):
         return struct.unpack_from("<I", buf, offset)[0]
     except struct.error:
         raise OverrunBufferException(offset, len(buf))
+    except TypeError:
+        return _read_unpackable("<I", buf, offset)
+
+
+def _read_unpackable(fmt, buf, offset):
+    """
+    The slow path of the read_* functions, for buffers that provide
+      their own `unpack_from` method.
+    """
+    if not hasattr(buf, "unpack_from"):
+        raise TypeError("Cannot unpack from %s" % (type(buf).__name__))
+    try:
+        return buf.unpack_from(fmt, offset)[0]
+    except struct.error:
+        raise OverrunBufferException(offset, len(buf))
 
 
 class Block(object):
@@ -384,6 +584,7 @@ class Block(object):
         - `offset`: The offset into the buffer at which the block starts.
         """
         self._buf = buf
+        self._unpack_from = get_unpack_from(buf)
         self._offset = offset
         self._implicit_offset = 0
         # list of dict(offset:number, type:string, name:string,
@@ -542,16 +743,19 @@ class Block(object):
         setattr(self, "_off_" + name, offset)
         self.add_explicit_field(offset, typename, name, length, count)
 
-        try:
-            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
-                                           name,
-                                           hex(self.absolute_offset(offset)),
-                                           str(handler())[:0x20]))
-        except ValueError: # invalid Windows timestamp
-            debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
-                                           name,
-                                           hex(self.absolute_offset(offset)),
-                                           "<<error>>"))
+        # only evaluate the field for the debug message when it will be shown,
+        #   since this runs for every field of every structure parsed.
+        if verbose:
+            try:
+                debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
+                                               name,
+                                               hex(self.absolute_offset(offset)),
+                                               str(handler())[:0x20]))
+            except ValueError: # invalid Windows timestamp
+                debug("(%s) %s\t@ %s\t: %s" % (typename.upper(),
+                                               name,
+                                               hex(self.absolute_offset(offset)),
+                                               "<<error>>"))
 
     def add_explicit_field(self, offset, typename, name, length=None, count=1):
         """
@@ -630,7 +834,11 @@ class Block(object):
         Throws:
         - `OverrunBufferException`
         """
-        return read_byte(self._buf, self._offset + offset)
+        o = self._offset + offset
+        try:
+            return self._unpack_from("<B", self._buf, o)[0]
+        except struct.error:
+            raise OverrunBufferException(o, len(self._buf))
 
     def unpack_int8(self, offset):
         """
@@ -642,7 +850,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<b", self._buf, o)[0]
+            return self._unpack_from("<b", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -655,7 +863,11 @@ class Block(object):
         Throws:
         - `OverrunBufferException`
         """
-        return read_word(self._buf, self._offset + offset)
+        o = self._offset + offset
+        try:
+            return self._unpack_from("<H", self._buf, o)[0]
+        except struct.error:
+            raise OverrunBufferException(o, len(self._buf))
 
     def unpack_word_be(self, offset):
         """
@@ -668,7 +880,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from(">H", self._buf, o)[0]
+            return self._unpack_from(">H", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -683,7 +895,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<h", self._buf, o)[0]
+            return self._unpack_from("<h", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -705,7 +917,11 @@ class Block(object):
         Throws:
         - `OverrunBufferException`
         """
-        return read_dword(self._buf, self._offset + offset)
+        o = self._offset + offset
+        try:
+            return self._unpack_from("<I", self._buf, o)[0]
+        except struct.error:
+            raise OverrunBufferException(o, len(self._buf))
 
     def unpack_dword_be(self, offset):
         """
@@ -717,7 +933,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from(">I", self._buf, o)[0]
+            return self._unpack_from(">I", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -732,7 +948,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<i", self._buf, o)[0]
+            return self._unpack_from("<i", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -746,7 +962,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<Q", self._buf, o)[0]
+            return self._unpack_from("<Q", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -761,7 +977,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<q", self._buf, o)[0]
+            return self._unpack_from("<q", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -776,7 +992,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<f", self._buf, o)[0]
+            return self._unpack_from("<f", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -791,7 +1007,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            return struct.unpack_from("<d", self._buf, o)[0]
+            return self._unpack_from("<d", self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -809,7 +1025,7 @@ class Block(object):
             return ""
         o = self._offset + offset
         try:
-            return struct.unpack_from("<%ds" % (length), self._buf, o)[0]
+            return self._unpack_from("<%ds" % (length), self._buf, o)[0]
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
 
@@ -879,7 +1095,7 @@ class Block(object):
         """
         o = self._offset + offset
         try:
-            parts = struct.unpack_from("<WWWWWWWW", self._buf, o)
+            parts = self._unpack_from("<WWWWWWWW", self._buf, o)
         except struct.error:
             raise OverrunBufferException(o, len(self._buf))
         return datetime.datetime(parts[0], parts[1],
@@ -1,276 +1,172 @@
 #!/usr/bin/python
 
+import os
+import bz2
 import sys
-from struct import unpack_from as old_unpack_from
-from struct import unpack_from as old_unpack
-from struct import calcsize
+import json
+import zlib
+import Queue
+import bisect
+import logging
+import threading
+import struct
 
 from collections import OrderedDict
-# From: http://code.activestate.com/recipes/577197-sortedcollection/
-from SortedCollection import SortedCollection
 
 
 MEGABYTE = 1024 * 1024
 
+# number of consecutive block reads before FileMap starts prefetching
+SEQUENTIAL_THRESHOLD = 2
 
-class LRUQueue(object):
-    """
-    LRUQueue is a data structure that orders objects by
-      their insertion time, and supports an update/touch operation
-      that resets an item to the newest slot.
-
-    This is an example of a priority queue, ordered by
-      insertion time, with explicit support for "touch".
-    """
-    def __init__(self, key=lambda n: n):
-        """
-        The `key` parameter may be provided if the
-          items in the queue are complex.
-        The `key` parameter should select a unique "id" field from
-          each item.
-        """
-        super(LRUQueue, self).__init__()
-        self._q = OrderedDict()
-        self._key = key
-
-    def push(self, v):
-        k = self._key(v)
-        self._q[k] = v
-
-    def pop(self):
-        return self._q.popitem(last=False)[1]
-
-    def touch(self, v):
-        """
-        Reset the given value back to the newest slot.
-        """
-        k = self._key(v)
-        del self._q[k]
-        self._q[k] = v
+# number of independently locked block caches in a thread safe FileMap
+CACHE_STRIPES = 8
 
-    def size(self):
-        return len(self._q)
+# uncompressed bytes between decompressor states saved by CompressedFile
+CHECKPOINT_INTERVAL = 16 * MEGABYTE
+# decompressor states kept by CompressedFile, each about 40KB for zlib,
+#   before it thins them out
+MAX_CHECKPOINT_STATES = 256
+# compressed bytes decompressed by CompressedFile at a time
+COMPRESSED_READ_SIZE = 64 * 1024
+# appended to the name of a compressed file to name its seek index
+INDEX_SUFFIX = ".seekidx"
 
-    def __len__(self):
-        return self.size()
-
-    @staticmethod
-    def test():
-        q = LRUQueue()
-        assert q.size() == 0
-        assert len(q) == 0
-
-        q.push(0)
-        assert q.size() == 1
-        assert len(q) == 1
-
-        assert q.pop() == 0
-        assert q.size() == 0
-        assert len(q) == 0
-
-        q.push(0)
-        q.push(1)
-        assert q.pop() == 0
-        assert q.pop() == 1
-
-        q.push(0)
-        q.push(1)
-        q.touch(0)
-        assert q.pop() == 1
-        assert q.pop() == 0
-
-        q = LRUQueue(key=lambda n: n[0])
-        q.push([0])
-        assert q.pop() == [0]
-
-        q.push([0])
-        q.push([1])
-        assert q.pop() == [0]
-        assert q.pop() == [1]
-        return True
+# compiled struct formats used by FileMap.unpack_from
+_STRUCTS = {}
 
 
-class BoundedLRUQueue(object):
+class BlockCache(object):
     """
-    BoundedLRUQueue is a LRUQueue with a finite capacity.
-      When an item is pushed that causes the capacity to be exceeded,
-      the LRU item is automatically popped.
+    BlockCache is a LRU cache of the blocks of a file, keyed
+      by block index. Lookups, insertions, and LRU updates are
+      constant time operations on an ordered dictionary.
 
-    Otherwise, this class behaves just like the LRUQueue.
+    The capacity is a number of bytes, rather than a number
+      of blocks, so that the memory used is independent of the
+      block size. The most recently used block is always kept,
+      even if it alone exceeds the capacity.
+
+    The cache counts its hits, misses, and evictions.
     """
-    def __init__(self, capacity, key=lambda n: n):
+    def __init__(self, capacity):
         """
-        The `key` parameter may be provided if the
-          items in the queue are complex.
-        The `key` parameter should select a unique "id" field from
-          each item.
+        @type capacity: int
+        @param capacity: The maximum number of bytes to cache.
         """
-        super(BoundedLRUQueue, self).__init__()
-        self._q = LRUQueue(key)
+        super(BlockCache, self).__init__()
+        self._blocks = OrderedDict()
         self._capacity = capacity
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    def push(self, v):
-        self._q.push(v)
-        if len(self._q) > self._capacity:
-            return self._q.pop()
-
-    def pop(self):
-        return self._q.pop()
-
-    def touch(self, v):
-        self._q.touch(v)
-
-    def size(self):
-        return len(self._q)
-
-    def __len__(self):
-        return self.size()
-
-    @staticmethod
-    def test():
-        q = BoundedLRUQueue(5)
-        assert q.size() == 0
-        assert len(q) == 0
-
-        q.push(0)
-        assert q.size() == 1
-        assert len(q) == 1
-
-        assert q.pop() == 0
-        assert q.size() == 0
-        assert len(q) == 0
-
-        q.push(0)
-        q.push(1)
-        assert q.pop() == 0
-        assert q.pop() == 1
-
-        q.push(0)
-        q.push(1)
-        q.touch(0)
-        assert q.pop() == 1
-        assert q.pop() == 0
-
-        q = BoundedLRUQueue(5, key=lambda n: n[0])
-        q.push([0])
-        assert q.pop() == [0]
-
-        q.push([0])
-        q.push([1])
-        assert q.pop() == [0]
-        assert q.pop() == [1]
-
-        q = BoundedLRUQueue(2)
-        assert q.push(0) is None
-        assert q.push(1) is None
-        assert q.push(2) == 0
-        assert q.pop() == 1
-        assert q.pop() == 2
-        return True
-
-
-class RangeCache(object):
-    """
-    RangeCache is a data structure that tracks a finite set of
-      ranges (a range is a 2-tuple consisting of a numeric start
-      and numeric length). New ranges can be added via the `push`
-      method, and if such a call causes the capacity to be exceeded,
-      then the "oldest" range is removed. The `get` method implements
-      an efficient lookup for a single value that may be found within
-      one of the ranges.
-    """
-    def __init__(self, capacity,
-                 start_key=lambda o: o[0],
-                 length_key=lambda o: o[1]):
-        """
-        @param key: A function that fetches the range start from an item.
+    def get(self, index):
         """
-        super(RangeCache, self).__init__()
-        self._ranges = SortedCollection(key=start_key)
-        self._lru = BoundedLRUQueue(capacity, key=start_key)
-        self._start_key = start_key
-        self._length_key = length_key
+        Fetch the block with the given index, and mark it as
+          the most recently used block.
 
-    def push(self, o):
+        @raise KeyError: if the block is not in the cache.
         """
-        Add a range to the cache.
-
-        If `key` is not provided to the constructor, then
-          `o` should be a 3-tuple:
-            - range start (numeric)
-            - range length (numeric)
-            - range item (object)
+        try:
+            buf = self._blocks.pop(index)
+        except KeyError:
+            self.misses += 1
+            raise
+        self._blocks[index] = buf
+        self.hits += 1
+        return buf
+
+    def peek(self, index):
         """
-        self._ranges.insert(o)
-        popped = self._lru.push(o)
-        if popped is not None:
-            self._ranges.remove(popped)
-
-    def touch(self, o):
-        self._lru.touch(o)
+        Fetch the block with the given index, or None if it is
+          not cached, without updating the LRU order or counters.
+        """
+        return self._blocks.get(index)
 
-    def get(self, value):
+    def put(self, index, buf):
         """
-        Search for the numeric `value` within the ranges
-          tracked by this cache.
-        @raise ValueError: if the value is not found in the range cache.
+        Add the block with the given index as the most recently used
+          block, evicting the least recently used blocks as necessary.
         """
-        hit = self._ranges.find_le(value)
-        if value < self._start_key(hit) + self._length_key(hit):
-            return hit
-        raise ValueError("%s not found in range cache" % value)
+        old = self._blocks.pop(index, None)
+        if old is not None:
+            self._size -= len(old)
+        self._blocks[index] = buf
+        self._size += len(buf)
 
-    @staticmethod
-    def test():
-        q = RangeCache(2)
-
-        x = None
-        try: x = q.get(0)
-        except ValueError: pass
-        assert x is None
-
-        x = None
-        try: x = q.get(1)
-        except ValueError: pass
-        assert x is None
-
-        q.push((1, 1, [0]))
+        while self._size > self._capacity and len(self._blocks) > 1:
+            _, evicted = self._blocks.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
 
-        x = None
-        try: x = q.get(0)
-        except ValueError: pass
-        assert x is None
-
-        assert q.get(1) == (1, 1, [0])
-        assert q.get(1.99) == (1, 1, [0])
-        x = None
-        try: x = q.get(2.01)
-        except ValueError: pass
-        assert x is None
+    def __contains__(self, index):
+        return index in self._blocks
 
-        q.push((3, 1, [1]))
-        assert q.get(1) == (1, 1, [0])
-        assert q.get(3) == (3, 1, [1])
+    def __len__(self):
+        return len(self._blocks)
 
-        q.push((5, 1, [2]))
-        x = None
-        try: x = q.get(1)
-        except ValueError: pass
-        assert x is None
+    def size(self):
+        """
+        The number of bytes currently cached.
+        """
+        return self._size
 
-        assert q.get(3) == (3, 1, [1])
-        assert q.get(5) == (5, 1, [2])
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "blocks": len(self._blocks),
+            "bytes": self._size,
+        }
 
-        q.touch((3, 1, [1]))
-        q.push((7, 1, [3]))
+    @staticmethod
+    def test():
+        c = BlockCache(8)
+        assert len(c) == 0
+        assert c.size() == 0
 
-        assert q.get(3) == (3, 1, [1])
-        assert q.get(7) == (7, 1, [3])
         x = None
-        try: x = q.get(5)
-        except ValueError: pass
+        try: x = c.get(0)
+        except KeyError: pass
         assert x is None
-
+        assert c.misses == 1
+
+        c.put(0, "0123")
+        assert 0 in c
+        assert c.get(0) == "0123"
+        assert c.hits == 1
+        assert c.size() == 4
+
+        c.put(1, "abcd")
+        assert c.size() == 8
+        assert c.peek(1) == "abcd"
+        assert c.peek(5) is None
+        assert c.hits == 1
+        assert c.evictions == 0
+
+        # 0 is now the most recently used
+        assert c.get(0) == "0123"
+        c.put(2, "4567")
+        assert c.evictions == 1
+        assert 1 not in c
+        assert 0 in c
+        assert 2 in c
+        assert c.size() == 8
+
+        # replacing a block does not double count it
+        c.put(2, "45")
+        assert c.size() == 6
+        assert len(c) == 2
+
+        # an oversized block is still kept
+        c.put(3, "0123456789")
+        assert len(c) == 1
+        assert c.get(3) == "0123456789"
+
+        assert c.stats()["hits"] == 3
         return True
 
 
@@ -286,96 +182,388 @@ class FileMap(object):
        2) You can stack this over any Python file-like objects.
             eg. FileMap over ZipFile gives you a random access buffer
                   thats backed by a compressed image on the file system.
+                  Over a CompressedFile, random access is cheap, too.
     """
     def __init__(self, filelike, block_size=MEGABYTE,
-                 cache_size=10, size=None):
+                 cache_size=10 * MEGABYTE, size=None, readahead=0,
+                 threadsafe=False):
         """
         If `size` is not provided, then `filelike` must have the
           `seek` and `tell` methods implemented.
+
+        `cache_size` is the number of bytes of blocks to cache.
+
+        If `readahead` is non-zero, then once blocks are read
+          sequentially, up to `readahead` following blocks are read
+          on a background thread, so that reads from slow storage
+          overlap parsing. A read elsewhere cancels pending prefetches.
+          The cache should be large enough to hold the prefetch window.
+          Call `close` to stop the background thread.
+
+        If `threadsafe` is True, then many threads may share the FileMap.
+          The cache is split into CACHE_STRIPES independently locked
+          caches. When `filelike` is a file opened from a path, each
+          thread reads through its own handle of that path, so that reads
+          do not share a seek position and may run concurrently. The
+          handles of exited threads are closed as new ones are opened.
+          Otherwise, reads of the underlying file are serialized.
         """
         super(FileMap, self).__init__()
         if size is None:
-            import os
             filelike.seek(0, os.SEEK_END)
             size = filelike.tell()
         self._f = filelike
         self._block_size = block_size
         self._size = size
-        self._block_cache = RangeCache(cache_size)
+
+        self._threadsafe = threadsafe
+        stripes = CACHE_STRIPES if threadsafe else 1
+        self._caches = [BlockCache(cache_size // stripes)
+                        for _ in xrange(stripes)]
+        self._cache_locks = [threading.Lock() for _ in xrange(stripes)]
+        # guards the position of the underlying file
+        self._io_lock = threading.Lock()
+
+        # the path from which each thread opens its own handle
+        self._filename = None
+        if threadsafe and isinstance(filelike, file) and \
+           isinstance(filelike.name, basestring) and \
+           os.path.isfile(filelike.name):
+            self._filename = filelike.name
+        self._local = threading.local()
+        # the handle of each thread, keyed by the thread
+        self._thread_files = {}
+
+        self._readahead = readahead
+        # guards the sequential access tracking
+        self._access_lock = threading.Lock()
+        self._last_block = -1
+        self._sequential = 0
+        self._prefetch_end = -1
+        # prefetches queued under an older generation are dropped
+        self._generation = 0
+        self._prefetched = 0
+        self._prefetch_queue = None
+        self._prefetcher = None
+
+        # the (index, contents) of the block last used by unpack_from,
+        #   when not thread safe
+        self._current = (-1, None)
+
+    def _peek_block(self, block_index):
+        """
+        Return the block with the given index if it is cached,
+          or None, without updating the cache.
+        """
+        stripe = block_index % len(self._caches)
+        with self._cache_locks[stripe]:
+            return self._caches[stripe].peek(block_index)
+
+    def _load_block(self, block_index):
+        """
+        Read a block from the underlying file, and cache it.
+        """
+        offset = block_index * self._block_size
+        if self._filename is not None:
+            f = self._thread_file()
+            f.seek(offset)
+            buf = f.read(self._block_size)
+        else:
+            with self._io_lock:
+                # another thread may have read the block while we waited
+                buf = self._peek_block(block_index)
+                if buf is not None:
+                    return buf
+                self._f.seek(offset)
+                buf = self._f.read(self._block_size)
+
+        stripe = block_index % len(self._caches)
+        with self._cache_locks[stripe]:
+            self._caches[stripe].put(block_index, buf)
+        return buf
+
+    def _thread_file(self):
+        """
+        Get the handle of the underlying file owned by the current thread,
+          opening it if needed. Opening a handle closes the handles of
+          threads that have exited, so that the number of open handles
+          is bounded by the number of live threads.
+        """
+        f = getattr(self._local, "f", None)
+        if f is None:
+            f = open(self._filename, "rb")
+            self._local.f = f
+            with self._io_lock:
+                for thread, g in self._thread_files.items():
+                    if not thread.is_alive():
+                        g.close()
+                        del self._thread_files[thread]
+                self._thread_files[threading.current_thread()] = f
+        return f
+
+    def _get_block(self, block_index):
+        """
+        Given a block index, return the contents of the block,
+          reading it from the underlying file if its not cached.
+        """
+        if self._readahead:
+            self._note_access(block_index)
+
+        stripe = block_index % len(self._caches)
+        with self._cache_locks[stripe]:
+            try:
+                return self._caches[stripe].get(block_index)
+            except KeyError:
+                pass
+        return self._load_block(block_index)
+
+    def _note_access(self, block_index):
+        """
+        Track the pattern of block reads, and schedule prefetches
+          when they are sequential.
+        """
+        with self._access_lock:
+            self._note_access_locked(block_index)
+
+    def _note_run(self, first_block, last_block):
+        """
+        Track a read of the run of blocks from `first_block`
+          to `last_block`, inclusive.
+        """
+        with self._access_lock:
+            self._note_access_locked(first_block)
+            # the rest of the run counts as read in order
+            self._last_block = last_block
+
+    def _note_access_locked(self, block_index):
+        last = self._last_block
+        if block_index == last:
+            return
+        self._last_block = block_index
+
+        if block_index != last + 1:
+            self._sequential = 0
+            self._prefetch_end = -1
+            self._generation += 1
+            return
+
+        self._sequential += 1
+        if self._sequential < SEQUENTIAL_THRESHOLD:
+            return
+
+        last_block = (self._size - 1) // self._block_size
+        first = max(self._prefetch_end + 1, block_index + 1)
+        end = min(block_index + self._readahead, last_block)
+        if first > end:
+            return
+
+        if self._prefetcher is None:
+            self._prefetch_queue = Queue.Queue()
+            self._prefetcher = threading.Thread(target=self._prefetch_worker,
+                                                name="FileMap prefetch")
+            self._prefetcher.daemon = True
+            self._prefetcher.start()
+        for i in xrange(first, end + 1):
+            self._prefetch_queue.put((self._generation, i))
+        self._prefetch_end = end
+
+    def _prefetch_worker(self):
+        while True:
+            item = self._prefetch_queue.get()
+            try:
+                if item is None:
+                    return
+                self._prefetch(*item)
+            finally:
+                self._prefetch_queue.task_done()
+
+    def _prefetch(self, generation, block_index):
+        if generation != self._generation:
+            return
+        if self._peek_block(block_index) is not None:
+            return
+        self._load_block(block_index)
+        self._prefetched += 1
+
+    def close(self):
+        """
+        Stop the prefetch thread, if there is one, and close the
+          handles opened for each thread.
+        This does not close the underlying file.
+        """
+        if self._prefetcher is not None:
+            self._generation += 1
+            self._prefetch_queue.put(None)
+            self._prefetcher.join()
+            self._prefetcher = None
+            self._prefetch_queue = None
+
+        with self._io_lock:
+            for f in self._thread_files.itervalues():
+                f.close()
+            self._thread_files = {}
+            self._local = threading.local()
 
     def __getitem__(self, index):
         if index < 0:
             index = self._size + index
-        block_index = index % self._block_size
-        block_start = index - block_index
-
-        try:
-            hit = self._block_cache.get(index)
-            buf = hit[2]
-            self._block_cache.touch(hit)
-            return buf[block_index]
-        except ValueError:
-            self._f.seek(block_start)
-            buf = self._f.read(self._block_size)
-            self._block_cache.push((block_start, self._block_size, buf))
-            return buf[block_index]
+        block_index, offset = divmod(index, self._block_size)
+        return self._get_block(block_index)[offset]
 
     def _get_containing_block(self, index):
         """
         Given an index, return block-aligned block that contains it,
           updating the appropriate caches.
         """
-        block_index = index % self._block_size
-        block_start = index - block_index
-
-        try:
-            hit = self._block_cache.get(block_start)
-            buf = hit[2]
-            self._block_cache.touch(hit)
-            return buf
-        except ValueError:
-            self._f.seek(block_start)
-            buf = self._f.read(self._block_size)
-            self._block_cache.push((block_start, self._block_size, buf))
-            return buf
+        return self._get_block(index // self._block_size)
 
-    def __getslice__(self, start, end):
-        if end == sys.maxint:
-            end = self._size
+    def cache_stats(self):
+        """
+        Return a dict of the hit, miss, and eviction counts of the
+          block cache, and the number of blocks prefetched.
+        """
+        stats = {}
+        for cache, lock in zip(self._caches, self._cache_locks):
+            with lock:
+                for k, v in cache.stats().iteritems():
+                    stats[k] = stats.get(k, 0) + v
+        stats["prefetched"] = self._prefetched
+        return stats
+
+    def _readinto(self, offset, view):
+        """
+        Read directly from the underlying file into the given
+          writable buffer, bypassing the block cache.
 
-        start_block_index = start % self._block_size
-        start_block_start = start - start_block_index
+        @raise IOError: if the file is shorter than expected.
+        """
+        if self._filename is not None:
+            self._readinto_file(self._thread_file(), offset, view)
+            return
+
+        with self._io_lock:
+            self._readinto_file(self._f, offset, view)
+
+    def _readinto_file(self, f, offset, view):
+        f.seek(offset)
+        readinto = getattr(f, "readinto", None)
+        n = 0
+        while n < len(view):
+            if readinto is not None:
+                count = readinto(view[n:])
+            else:
+                data = f.read(len(view) - n)
+                count = len(data)
+                view[n:n + count] = data
+            if not count:
+                raise IOError("Short read at offset %s" % (hex(offset + n)))
+            n += count
+
+    def _read_range(self, start, end):
+        """
+        Assemble the bytes from `start` to `end` into a single
+          preallocated bytearray.
+        Cached blocks, and the partial blocks at either end of the range,
+          are copied from the block cache. Runs of complete uncached
+          blocks are read straight into the result with one read,
+          so that large reads do not flush the cache.
+        """
+        bs = self._block_size
+        ret = bytearray(end - start)
+        view = memoryview(ret)
+        pos = start
+        while pos < end:
+            block_index, offset = divmod(pos, bs)
+            if offset == 0 and pos + bs <= end and \
+               self._peek_block(block_index) is None:
+                run_end = pos + bs
+                while run_end + bs <= end and \
+                      self._peek_block(run_end // bs) is None:
+                    run_end += bs
+                if self._readahead:
+                    self._note_run(block_index, run_end // bs - 1)
+                self._readinto(pos, view[pos - start:run_end - start])
+                pos = run_end
+            else:
+                buf = self._get_block(block_index)
+                count = min(bs - offset, end - pos)
+                view[pos - start:pos - start + count] = buf[offset:offset + count]
+                pos += count
+        return ret
+
+    def _clamp(self, start, end):
+        return max(start, 0), min(end, self._size)
 
-        end_block_index = end % self._block_size
-        end_block_start = end - end_block_index
+    def __getslice__(self, start, end):
+        start, end = self._clamp(start, end)
+        if start >= end:
+            return ""
 
-        if start_block_start == end_block_start:
+        start_block, offset = divmod(start, self._block_size)
+        if start_block == (end - 1) // self._block_size:
             # easy case, everything falls within the same block
-            buf = self._get_containing_block(start)
-            return buf[start_block_index:end_block_index]
+            buf = self._get_block(start_block)
+            return buf[offset:offset + end - start]
         else:
             # hard case, slice goes over one or more block boundaries
-            ret = ""
-
-            # phase 1, start to block boundary
-            buf = self._get_containing_block(start_block_start)
-            s = start_block_index
-            e = start_block_start + self._block_size
-            ret += buf[s:e]
-
-            # phase 2, any complete blocks
-            cur_block_start = start_block_start + self._block_size
-            while cur_block_start + self._block_size < end_block_start:
-                buf = self._get_containing_block(cur_block_start)
-                ret += buf
-                cur_block_start += self._block_size
-
-            # phase 3, block boundary to end
-            buf = self._get_containing_block(cur_block_start)
-            s = 0
-            e = end_block_index or self._block_size
-            ret += buf[0:e]
-            return ret
+            return str(self._read_range(start, end))
+
+    def view(self, start, end):
+        """
+        Like a slice, but return a read-only `buffer` object. When the
+          range falls within a single block, the buffer refers directly
+          to the cached block and no bytes are copied.
+        """
+        start, end = self._clamp(start, end)
+        if start >= end:
+            return buffer("")
+
+        start_block, offset = divmod(start, self._block_size)
+        if start_block == (end - 1) // self._block_size:
+            return buffer(self._get_block(start_block), offset, end - start)
+        else:
+            return buffer(self._read_range(start, end))
+
+    def unpack_from(self, fmt, offset):
+        """
+        Like struct.unpack_from, but for a FileMap, which is not a buffer.
+        A value that falls within a single block is unpacked directly
+          from the cached block, so no bytes are copied. Only values
+          that straddle a block boundary are copied out first.
+        BinaryParser.Block calls this for a FileMap, as chosen by
+          BinaryParser.get_unpack_from, so that Blocks can parse a FileMap.
+
+        @raise struct.error: if the value extends beyond the end of the file.
+        """
+        try:
+            s = _STRUCTS[fmt]
+        except KeyError:
+            s = _STRUCTS[fmt] = struct.Struct(fmt)
+
+        block_index, block_offset = divmod(offset, self._block_size)
+        if block_offset + s.size > self._block_size or offset < 0:
+            return s.unpack_from(self[offset:offset + s.size])
+
+        # consecutive fields usually come from the same block
+        current_index, buf = self._current
+        if current_index == block_index:
+            self._reuse_current_block(block_index)
+        else:
+            buf = self._get_block(block_index)
+            if not self._threadsafe:
+                self._current = (block_index, buf)
+        return s.unpack_from(buf, block_offset)
+
+    def _reuse_current_block(self, block_index):
+        """
+        Track a read of the block last used by `unpack_from`, as
+          `_get_block` would, without looking it up in the cache.
+        This is only used when the FileMap is not thread safe,
+          so there is a single cache, and the counter needs no lock.
+        """
+        if self._readahead:
+            self._note_access(block_index)
+        self._caches[0].hits += 1
 
     def __len__(self):
         return self._size
@@ -384,7 +572,7 @@ class FileMap(object):
     def test():
         from cStringIO import StringIO
         f = StringIO("0123abcd4567efgh")
-        buf = FileMap(f, block_size=4, cache_size=2)
+        buf = FileMap(f, block_size=4, cache_size=8)
 
         assert len(buf) == 16
 
@@ -408,59 +596,543 @@ class FileMap(object):
         assert buf[-4:] == "efgh"
         assert buf[-8:] == "4567efgh"
 
+        # ranges that end on, or just past, block boundaries
+        assert buf[2:13] == "23abcd4567e"
+        assert buf[4:12] == "abcd4567"
+        assert buf[3:5] == "3a"
+        assert buf[12:16] == "efgh"
+        assert buf[15:100] == "h"
+        assert buf[8:4] == ""
+
+        assert str(buf.view(4, 6)) == "ab"
+        assert str(buf.view(2, 13)) == "23abcd4567e"
+
+        # no more than two blocks fit in the cache
+        assert buf.cache_stats()["bytes"] <= 8
+        assert buf.cache_stats()["evictions"] > 0
+
+        # values are unpacked from within and across blocks
+        from BinaryParser import Block
+        from BinaryParser import OverrunBufferException
+        b = Block(buf, 2)
+        assert b.unpack_word(0) == 0x3332
+        assert b.unpack_dword(0) == 0x62613332
+        assert b.unpack_qword(4) == struct.unpack("<Q", "cd4567ef")[0]
+        assert b.unpack_binary(1, 4) == "3abc"
+        try:
+            b.unpack_dword(12)
+            assert False
+        except OverrunBufferException:
+            pass
+        assert buf.unpack_from("<I", 12) == (0x68676665, )
+
+        # complete uncached blocks are read directly into the result,
+        #   with and without `readinto`
+        from io import BytesIO
+        for f in (StringIO("0123abcd4567efgh"), BytesIO("0123abcd4567efgh")):
+            buf = FileMap(f, block_size=4, cache_size=8)
+            assert buf[1:16] == "123abcd4567efgh"
+            assert buf[:] == "0123abcd4567efgh"
+            assert buf[4] == "a"
+            assert buf[0:12] == "0123abcd4567"
+
+        # sequential reads prefetch the following blocks
+        data = "".join(chr(i) * 4 for i in xrange(64))
+        buf = FileMap(StringIO(data), block_size=4, cache_size=64, readahead=4)
+        for i in xrange(0, 32, 4):
+            assert buf[i] == data[i]
+        buf._prefetch_queue.join()
+        assert buf.cache_stats()["prefetched"] > 0
+        for i in xrange(32, 64, 4):
+            assert buf[i] == data[i]
+        assert buf[3:61] == data[3:61]
+        buf.close()
+
+        # unpacking from the current block counts as a cache hit,
+        #   and sequential unpacks prefetch, too
+        buf = FileMap(StringIO(data), block_size=4, cache_size=64, readahead=4)
+        for i in xrange(0, 32, 2):
+            assert buf.unpack_from("<B", i) == (ord(data[i]), )
+        buf._prefetch_queue.join()
+        assert buf.cache_stats()["hits"] >= 8
+        assert buf.cache_stats()["prefetched"] > 0
+        buf.close()
+
+        # random access does not prefetch
+        buf = FileMap(StringIO(data), block_size=4, cache_size=64, readahead=4)
+        for i in (40, 0, 20, 8, 60):
+            assert buf[i] == data[i]
+        buf.close()
+        assert buf.cache_stats()["prefetched"] == 0
+
+        # many threads share one FileMap
+        import random
+        import tempfile
+        data = "".join(chr(random.randint(0, 255)) for _ in xrange(0x10000))
+        t = tempfile.NamedTemporaryFile()
+        t.write(data)
+        t.flush()
+        # with a handle per thread, and with serialized reads
+        for f in (open(t.name, "rb"), StringIO(data)):
+            buf = FileMap(f, block_size=0x100, cache_size=0x2000, threadsafe=True)
+            errors = []
+
+            def reader(seed):
+                r = random.Random(seed)
+                for _ in xrange(500):
+                    start = r.randint(0, len(data))
+                    end = start + r.randint(0, 0x400)
+                    if buf[start:end] != data[start:end]:
+                        errors.append((start, end))
+            threads = [threading.Thread(target=reader, args=(i,))
+                       for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not errors
+            assert buf.cache_stats()["bytes"] <= 0x2000
+            assert len(buf._thread_files) == (8 if isinstance(f, file) else 0)
+            buf.close()
+            assert not buf._thread_files
+            f.close()
+
+        # the handles of exited threads are closed, not leaked
+        buf = FileMap(open(t.name, "rb"), block_size=0x100, threadsafe=True)
+        opened = []
+
+        def churn(i):
+            assert buf[i * 0x100] == data[i * 0x100]
+            opened.append(buf._local.f)
+        for i in xrange(32):
+            thread = threading.Thread(target=churn, args=(i,))
+            thread.start()
+            thread.join()
+            assert len(buf._thread_files) == 1
+        assert all(f.closed for f in opened[:-1])
+        assert buf[0] == data[0]
+        assert len(buf._thread_files) == 1
+        buf.close()
+        assert opened[-1].closed
+        buf._f.close()
+        t.close()
+
         return True
 
 
-def unpack_from(fmt, buffer, off=0):
+def detect_compression(f):
     """
-    Shim struct.unpack_from and divert unpacking of FileMaps.
-
-    Otherwise, you'd get an exception like:
-      TypeError: unpack_from() argument 1 must be convertible to a buffer, not FileMap
+    Guess the compression format of a file from its magic.
 
-    So, we extract a true sub-buffer from the FileMap, and feed this
-      back into the old unpack function.
-    Theres an extra allocation and copy, but there's no getting
-      around that.
+    @rtype: str
+    @return: One of "gzip", "bz2", or "zlib".
+    @raise ValueError: if the format is not recognized.
     """
-    if not isinstance(buffer, FileMap):
-        return old_unpack_from(fmt, buffer, off)
-    size = calcsize(fmt)
-    buf = buffer[off:off + size]
-    return old_unpack_from(fmt, buf, 0x0)
-
-
-def unpack(fmt, string):
+    f.seek(0)
+    magic = f.read(3)
+    for compression in ("gzip", "bz2", "zlib"):
+        if has_compression_magic(compression, magic):
+            return compression
+    raise ValueError("Unknown compression format")
+
+
+def has_compression_magic(compression, magic):
+    if compression == "gzip":
+        return magic[:2] == "\x1f\x8b"
+    elif compression == "bz2":
+        return magic[:3] == "BZh"
+    elif compression == "zlib":
+        if len(magic) < 2:
+            return False
+        cmf, flg = ord(magic[0]), ord(magic[1])
+        return cmf & 0x0F == 8 and (cmf * 256 + flg) % 31 == 0
+    raise ValueError("Unknown compression format: %s" % (compression))
+
+
+def new_decompressor(compression):
+    if compression == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == "bz2":
+        return bz2.BZ2Decompressor()
+    elif compression == "zlib":
+        return zlib.decompressobj()
+    raise ValueError("Unknown compression format: %s" % (compression))
+
+
+class CompressedFile(object):
     """
-    Like the shimmed unpack_from, but for struct.unpack.
+    CompressedFile is a read-only, seekable file-like object over
+      a gzip, zlib, or bz2 compressed file. Stack a FileMap over it
+      to parse a compressed image or $MFT in place.
+
+    Seeking in a compressed stream usually means decompressing from
+      the start. Instead, CompressedFile keeps seek points: the start
+      of each member of a multi-member file (eg. from pigz, bgzip, or
+      pbzip2), and, for gzip and zlib, a copy of the decompressor state
+      every `checkpoint_interval` bytes. A read resumes from the
+      nearest seek point before it. At most MAX_CHECKPOINT_STATES
+      decompressor states are kept; beyond that, the interval is
+      doubled and every other state is dropped.
+
+    Discovering the size of the file takes one pass over it, which
+      records the seek points. The member boundaries and the size are
+      saved in a sidecar JSON file (by default, the filename with
+      INDEX_SUFFIX appended) and reloaded next time.
+
+    Limits: only the member boundaries persist. The decompressor states
+      exist only in memory, as the zlib module of Python 2 can neither
+      serialize them nor prime a decompressor with a saved window and
+      bit offset, as a zran style index would need. So, after the file
+      is reopened, a read within a single member stream costs time
+      proportional to its offset until the states are rebuilt. bz2
+      decompressors cannot be copied, so a bz2 stream has no seek
+      points within a member, and every backward seek within a member
+      decompresses from the start of that member. Random access is only
+      cheap across restarts for multi-member files, such as those
+      written by bgzip or pbzip2.
     """
-    if not isinstance(buffer, FileMap):
-        return old_unpack(fmt, string)
-    size = calcsize(fmt)
-    buf = string[:size]
-    return old_unpack(fmt, buf, 0x0)
+    def __init__(self, f, compression=None,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, index_path=None):
+        """
+        @type f: file-like object with `seek`, `tell`, and `read`.
+        @param compression: One of "gzip", "bz2", or "zlib", or
+          None to detect the format.
+        @param index_path: The path of the sidecar index, or None to
+          derive it from the name of `f`, or False to not use one.
+        """
+        super(CompressedFile, self).__init__()
+        self._f = f
+        f.seek(0, os.SEEK_END)
+        self._compressed_size = f.tell()
+        if compression is None:
+            compression = detect_compression(f)
+        self._compression = compression
+        self._interval = checkpoint_interval
+        self._read_size = COMPRESSED_READ_SIZE
+        self._size = None
+        self._pos = 0
+
+        # seek points are (uncompressed offset, compressed offset,
+        #   decompressor or None for the start of a member)
+        self._checkpoints = [(0, 0, None)]
+        self._offsets = [0]
+        self._state_count = 0
+        self._members = set([(0, 0)])
+
+        # the decompression stream
+        self._d = None
+        self._cpos = 0
+        self._upos = 0
+        self._buf = ""
+        self._eof = False
+
+        if index_path is None:
+            name = getattr(f, "name", None)
+            if isinstance(name, basestring):
+                index_path = name + INDEX_SUFFIX
+        self._index_path = index_path
+        if self._index_path:
+            self._load_index()
+
+    def _add_checkpoint(self, upos, cpos, d):
+        i = bisect.bisect_right(self._offsets, upos)
+        if d is not None:
+            # keep decompressor states at least an interval apart
+            if upos - self._offsets[i - 1] < self._interval:
+                return
+            if i < len(self._offsets) and \
+               self._offsets[i] - upos < self._interval:
+                return
+            d = d.copy()
+        elif self._offsets[i - 1] == upos:
+            if self._checkpoints[i - 1][2] is not None:
+                self._state_count -= 1
+            self._checkpoints[i - 1] = (upos, cpos, None)
+            return
+        self._offsets.insert(i, upos)
+        self._checkpoints.insert(i, (upos, cpos, d))
+        if d is not None:
+            self._state_count += 1
+            while self._state_count > MAX_CHECKPOINT_STATES:
+                self._thin_checkpoints()
+
+    def _thin_checkpoints(self):
+        """
+        Double the checkpoint interval, and drop the decompressor
+          states that are now closer than an interval to the
+          previous seek point. Member starts are always kept.
+        """
+        self._interval *= 2
+        checkpoints = []
+        for checkpoint in self._checkpoints:
+            if checkpoint[2] is not None and \
+               checkpoint[0] - checkpoints[-1][0] < self._interval:
+                continue
+            checkpoints.append(checkpoint)
+        self._checkpoints = checkpoints
+        self._offsets = [c[0] for c in checkpoints]
+        self._state_count = sum(1 for c in checkpoints if c[2] is not None)
+
+    def _load_index(self):
+        try:
+            with open(self._index_path, "rb") as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            return
+        if index.get("version") != 1 or \
+           index.get("compression") != self._compression or \
+           index.get("compressed_size") != self._compressed_size:
+            logging.warning("Ignoring stale seek index %s", self._index_path)
+            return
+        self._size = index["size"]
+        for cpos, upos in index["members"]:
+            self._members.add((cpos, upos))
+            self._add_checkpoint(upos, cpos, None)
+
+    def _save_index(self):
+        index = {
+            "version": 1,
+            "compression": self._compression,
+            "compressed_size": self._compressed_size,
+            "size": self._size,
+            "members": sorted(self._members),
+        }
+        try:
+            with open(self._index_path, "wb") as f:
+                json.dump(index, f)
+        except IOError as e:
+            logging.warning("Unable to save seek index %s: %s",
+                            self._index_path, e)
+
+    def _restart(self, pos):
+        """
+        Position the decompression stream at the nearest seek
+          point before `pos`, unless it is already closer.
+        """
+        i = bisect.bisect_right(self._offsets, pos) - 1
+        upos, cpos, d = self._checkpoints[i]
+        if self._d is not None and upos <= self._upos <= pos:
+            return
+        if d is None:
+            self._d = new_decompressor(self._compression)
+        else:
+            self._d = d.copy()
+        self._cpos = cpos
+        self._upos = upos
+        self._buf = ""
+        self._eof = False
 
+    def _fill(self):
+        """
+        Replace the buffer with the output of decompressing
+          the next chunk of input.
 
-def struct_test():
-    from cStringIO import StringIO
-    f = StringIO("\x04\x03\x02\x01")
-    buf = FileMap(f)
-    assert unpack_from("<B", buf, 0x0)[0] == 0x04
-    assert unpack_from("<H", buf, 0x0)[0] == 0x0304
-    assert unpack_from("<I", buf, 0x0)[0] == 0x01020304
+        @rtype: bool
+        @return: False at the end of the compressed data.
+        """
+        self._upos += len(self._buf)
+        self._buf = ""
+        if self._eof:
+            return False
+
+        self._f.seek(self._cpos)
+        data = self._f.read(self._read_size)
+        if not data:
+            self._set_eof()
+            return False
+
+        try:
+            if self._compression == "bz2":
+                self._buf = self._d.decompress(data)
+                unconsumed = ""
+            else:
+                # bound the output of highly compressed data
+                self._buf = self._d.decompress(data, self._read_size * 16)
+                unconsumed = self._d.unconsumed_tail
+            unused = self._d.unused_data
+        except EOFError:
+            # BZ2Decompressor, after the end of a stream
+            unconsumed = ""
+            unused = data
+        self._cpos += len(data) - len(unconsumed) - len(unused)
+        end = self._upos + len(self._buf)
+
+        if unused:
+            self._f.seek(self._cpos)
+            if has_compression_magic(self._compression,
+                                     self._f.read(3)):
+                self._d = new_decompressor(self._compression)
+                self._members.add((self._cpos, end))
+                self._add_checkpoint(end, self._cpos, None)
+            else:
+                # trailing garbage, such as padding
+                self._set_eof(end)
+        elif self._compression != "bz2":
+            self._add_checkpoint(end, self._cpos, self._d)
+        return True
+
+    def _set_eof(self, end=None):
+        if end is None:
+            end = self._upos + len(self._buf)
+        self._eof = True
+        if self._size is None:
+            self._size = end
+            if self._index_path:
+                self._save_index()
+
+    def size(self):
+        """
+        The uncompressed size of the file. The first call may
+          decompress the whole file.
+        """
+        if self._size is None:
+            self._restart(self._offsets[-1])
+            while self._fill():
+                pass
+        return self._size
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            self._pos = offset
+        elif whence == os.SEEK_CUR:
+            self._pos += offset
+        elif whence == os.SEEK_END:
+            self._pos = self.size() + offset
+        else:
+            raise ValueError("Invalid whence: %s" % (whence))
+        if self._pos < 0:
+            raise IOError("Invalid offset: %s" % (self._pos))
+
+    def tell(self):
+        return self._pos
+
+    def read(self, n=-1):
+        if n < 0:
+            n = max(self.size() - self._pos, 0)
+
+        pos = self._pos
+        self._restart(pos)
+        chunks = []
+        remaining = n
+        while remaining > 0:
+            if pos >= self._upos + len(self._buf):
+                if not self._fill():
+                    break
+                continue
+            start = pos - self._upos
+            chunk = self._buf[start:start + remaining]
+            chunks.append(chunk)
+            pos += len(chunk)
+            remaining -= len(chunk)
+        self._pos = pos
+        return "".join(chunks)
+
+    def close(self):
+        self._d = None
+        self._buf = ""
+        self._checkpoints = [(0, 0, None)]
+        self._offsets = [0]
+        self._state_count = 0
+
+    @staticmethod
+    def test():
+        import gzip
+        import random
+        import shutil
+        import tempfile
+        from cStringIO import StringIO
+
+        r = random.Random(0)
+        data = "".join(chr(r.randint(0, 8)) for _ in xrange(0x20000))
+
+        def gzip_members(*parts):
+            ret = []
+            for part in parts:
+                s = StringIO()
+                g = gzip.GzipFile(fileobj=s, mode="wb")
+                g.write(part)
+                g.close()
+                ret.append(s.getvalue())
+            return "".join(ret)
+
+        half = len(data) // 2
+        streams = [
+            ("gzip", gzip_members(data)),
+            ("gzip", gzip_members(data[:half], data[half:])),
+            ("gzip", gzip_members(data) + "\x00" * 16),
+            ("zlib", zlib.compress(data)),
+            ("bz2", bz2.compress(data[:half]) + bz2.compress(data[half:])),
+        ]
+        for compression, stream in streams:
+            f = CompressedFile(StringIO(stream), index_path=False,
+                               checkpoint_interval=0x1000)
+            assert f._compression == compression
+            f._read_size = 0x400
+            assert f.size() == len(data)
+            if compression != "bz2":
+                assert len(f._checkpoints) > 2
+            for _ in xrange(50):
+                start = r.randint(0, len(data))
+                f.seek(start)
+                count = r.randint(0, 0x2000)
+                assert f.read(count) == data[start:start + count]
+            f.seek(-4, os.SEEK_END)
+            assert f.read() == data[-4:]
+            assert f.read(1) == ""
+
+            buf = FileMap(CompressedFile(StringIO(stream), index_path=False),
+                          block_size=0x1000)
+            assert buf[0x1234:0x5678] == data[0x1234:0x5678]
+
+        # decompressor states are thinned out beyond the cap
+        global MAX_CHECKPOINT_STATES
+        saved, MAX_CHECKPOINT_STATES = MAX_CHECKPOINT_STATES, 4
+        try:
+            f = CompressedFile(StringIO(zlib.compress(data)),
+                               index_path=False, checkpoint_interval=0x400)
+            f._read_size = 0x100
+            assert f.size() == len(data)
+            assert 0 < f._state_count <= 4
+            assert f._state_count == \
+                sum(1 for c in f._checkpoints if c[2] is not None)
+            assert f._interval > 0x400
+            for _ in xrange(20):
+                start = r.randint(0, len(data))
+                f.seek(start)
+                assert f.read(0x800) == data[start:start + 0x800]
+            assert f._state_count <= 4
+        finally:
+            MAX_CHECKPOINT_STATES = saved
+
+        # the sidecar index records the size and members
+        d = tempfile.mkdtemp()
+        try:
+            path = os.path.join(d, "image.gz")
+            with open(path, "wb") as g:
+                g.write(streams[1][1])
+            with open(path, "rb") as g:
+                f = CompressedFile(g)
+                assert f.size() == len(data)
+            assert os.path.exists(path + INDEX_SUFFIX)
+            with open(path, "rb") as g:
+                f = CompressedFile(g)
+                assert f._size == len(data)
+                assert len(f._members) == 2
+                f.seek(half + 10)
+                assert f.read(10) == data[half + 10:half + 20]
+        finally:
+            shutil.rmtree(d)
+
+        return True
 
 
 def test():
-    if LRUQueue.test():
-        print "LRUQueue passed tests."
-    if BoundedLRUQueue.test():
-        print "BoundedLRUQueue passed tests."
-    if RangeCache.test():
-        print "RangeCache passed tests."
+    if BlockCache.test():
+        print "BlockCache passed tests."
     if FileMap.test():
         print "FileMap passed tests."
-    if struct_test():
-        print "struct passed tests."
+    if CompressedFile.test():
+        print "CompressedFile passed tests."
 
 
 if __name__ == "__main__":
@@ -20,15 +20,18 @@
 #   Version v.1.1.8
 import array
 import os
+import bisect
 import sys
 import struct
 import logging
+import threading
 from datetime import datetime
-from collections import OrderedDict  # python 2.7 only
 
 from BinaryParser import Block
 from BinaryParser import Nestable
 from BinaryParser import memoize
+from BinaryParser import Cache
+from BinaryParser import parse_size
 from BinaryParser import align
 from BinaryParser import ParseException
 from BinaryParser import OverrunBufferException
@@ -48,7 +51,9 @@ class INDXException(Exception):
         Arguments:
         - `value`: A string description.
         """
-        super(INDXException, self).__init__()
+        # pass the value on, so that the exception can be pickled,
+        #   such as from an INDXParse --jobs worker
+        super(INDXException, self).__init__(value)
         self._value = value
 
     def __str__(self):
@@ -88,6 +93,26 @@ class INDEX_ENTRY_FLAGS:
     INDEX_ENTRY_SPACE_FILLER = 0xFFFF
 
 
+# the generic index entry header: the entry length, key length, and flags
+INDEX_ENTRY_HEADER_STRUCT = struct.Struct("<8xHHH")
+
+# the four timestamps of the filename information in a directory index entry
+INDEX_ENTRY_TIMESTAMPS_STRUCT = struct.Struct("<24xQQQQ")
+
+# slack entries are only recovered if their timestamps fall within this range
+SLACK_ENTRY_RECENT_DATE = datetime(1990, 1, 1, 0, 0, 0)
+SLACK_ENTRY_FUTURE_DATE = datetime(2025, 1, 1, 0, 0, 0)
+
+
+def filetime(dt):
+    """
+    Return the Windows FILETIME QWORD for the given datetime.
+    This is the inverse of BinaryParser.parse_filetime.
+    """
+    delta = dt - datetime(1601, 1, 1, 0, 0, 0)
+    return ((delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds) * 10
+
+
 class INDEX_ENTRY_HEADER(Block, Nestable):
     def __init__(self, buf, offset, parent):
         super(INDEX_ENTRY_HEADER, self).__init__(buf, offset)
@@ -206,6 +231,11 @@ class SII_INDEX_ENTRY(Block, Nestable):
         super(SII_INDEX_ENTRY, self).__init__(buf, offset)
         self.declare_field(SECURE_INDEX_ENTRY_HEADER, "header", 0x0)
         self.declare_field("dword", "security_id")
+        # data: the location of the descriptor in the $SDS stream
+        self.declare_field("dword", "descriptor_hash")
+        self.declare_field("dword", "descriptor_security_id")
+        self.declare_field("qword", "descriptor_offset")
+        self.declare_field("dword", "descriptor_length")
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -216,8 +246,8 @@ class SII_INDEX_ENTRY(Block, Nestable):
 
     def is_valid(self):
         # TODO(wb): test
-        return 1 < self.header().length() < 0x30 and \
-            1 < self.header().key_lenght() < 0x20
+        return 1 < self.header().length() <= 0x30 and \
+            1 < self.header().key_length() < 0x20
 
 
 class SDH_INDEX_ENTRY(Block, Nestable):
@@ -229,6 +259,11 @@ class SDH_INDEX_ENTRY(Block, Nestable):
         self.declare_field(SECURE_INDEX_ENTRY_HEADER, "header", 0x0)
         self.declare_field("dword", "hash")
         self.declare_field("dword", "security_id")
+        # data: the location of the descriptor in the $SDS stream
+        self.declare_field("dword", "descriptor_hash")
+        self.declare_field("dword", "descriptor_security_id")
+        self.declare_field("qword", "descriptor_offset")
+        self.declare_field("dword", "descriptor_length")
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -239,8 +274,8 @@ class SDH_INDEX_ENTRY(Block, Nestable):
 
     def is_valid(self):
         # TODO(wb): test
-        return 1 < self.header().length() < 0x30 and \
-            1 < self.header().key_lenght() < 0x20
+        return 1 < self.header().length() <= 0x30 and \
+            1 < self.header().key_length() < 0x20
 
 
 class INDEX_HEADER_FLAGS:
@@ -378,32 +413,66 @@ class NTATTR_STANDARD_INDEX_HEADER(Block):
                            self.entry_list_start(),
                            self.entry_list_allocation_end() - self.entry_list_start())
 
-    def entries(self):
+    def entries(self, entry_class=None):
         """
         A generator that returns each INDX entry associated with this node.
+        The generic entry header (length and flags) is read with a
+          single unpack, and only live entries are constructed.
+
+        Arguments:
+        - `entry_class`: The type of the entries in this index.
+            Defaults to IndexEntry, the $I30 directory index entry.
         """
+        if entry_class is None:
+            entry_class = IndexEntry
+
         offset = self.entry_list_start()
         if offset == 0:
             return
 
-        # 0x52 is an approximate size of a small index entry
-        while offset <= self.entry_list_end() - 0x52:
-            e = IndexEntry(self._buf, self.offset() + offset, self)
-            offset += e.length()
-            yield e
+        buf = self._buf
+        offset += self.offset()
+        end = self.offset() + self.entry_list_end()
+        while offset + INDEX_ENTRY_HEADER_STRUCT.size <= end:
+            try:
+                length, _, flags = INDEX_ENTRY_HEADER_STRUCT.unpack_from(buf, offset)
+            except struct.error:
+                return
+            if length == 0 or flags & INDEX_ENTRY_FLAGS.INDEX_ENTRY_END:
+                return
+            yield entry_class(buf, offset, self)
+            offset += length
 
-    def slack_entries(self):
+    def slack_entries(self, future_date=SLACK_ENTRY_FUTURE_DATE):
         """
         A generator that yields INDX entries found in the slack space
         associated with this header.
+
+        Arguments:
+        - `future_date`: Entries with a timestamp at or after this
+            datetime are not recovered.
         """
-        offset = self.entry_list_end()
+        buf = self._buf
+        recent = filetime(SLACK_ENTRY_RECENT_DATE)
+        future = filetime(future_date)
+        offset = self.offset() + self.entry_list_end()
         try:
             # 0x52 is an approximate size of a small index entry
-            while offset <= self.entry_list_allocation_end() - 0x52:
+            while offset <= self.offset() + self.entry_list_allocation_end() - 0x52:
+                # cheaply reject most offsets by their raw timestamps
+                #  before parsing a candidate entry.
+                created, modified, changed, accessed = \
+                    INDEX_ENTRY_TIMESTAMPS_STRUCT.unpack_from(buf, offset)
+                if not (recent < created < future and
+                        recent < modified < future and
+                        recent < changed < future and
+                        recent < accessed < future):
+                    offset += 1
+                    continue
+
                 try:
-                    e = SlackIndexEntry(self._buf, offset, self)
-                    if e.is_valid():
+                    e = SlackIndexEntry(buf, offset, self)
+                    if e.is_valid(future_date):
                         offset += e.length() or 1
                         yield e
                     else:
@@ -444,7 +513,24 @@ class IndexRecordHeader(FixupBlock):
         self.declare_field("qword", "lsn")
         self.declare_field("qword", "vcn")
         self._node_header_offset = self.current_field_offset()
-        self.fixup(self.usa_count(), self.usa_offset())
+
+        self._has_valid_fixups = True
+        # an unset update sequence number with an empty array means the
+        #  fixups were never written, such as in some carved records.
+        num_fixups = self.usa_count() - 1
+        if num_fixups > 0 and \
+           self.unpack_binary(self.usa_offset(), 2 * (num_fixups + 1)) == "\x00\x00" * (num_fixups + 1):
+            logging.warning("Fixup array is empty at %s", hex(self.offset()))
+            self._has_valid_fixups = False
+        else:
+            self.fixup(self.usa_count(), self.usa_offset())
+
+    def has_valid_fixups(self):
+        """
+        Returns False if the update sequence array is empty, in which
+          case the entries of this record should not be trusted.
+        """
+        return self._has_valid_fixups
 
     def node_header(self):
         return NTATTR_STANDARD_INDEX_HEADER(self._buf,
@@ -452,6 +538,65 @@ class IndexRecordHeader(FixupBlock):
                                self)
 
 
+INDEX_NODE_BLOCK_SIZE = 4096
+
+
+def index_block_size(buf, offset):
+    """
+    Get the size of the INDX record at the given offset, as walked
+      by `index_blocks`: its allocated size rounded up to
+      INDEX_NODE_BLOCK_SIZE, or INDEX_NODE_BLOCK_SIZE if the block
+      is not an INDX record.
+
+    @rtype: int
+    """
+    if buf[offset:offset + 4] != "INDX":
+        return INDEX_NODE_BLOCK_SIZE
+    # the allocated size is relative to the node header at 0x18
+    allocated_size = read_dword(buf, offset + 0x20)
+    return max(INDEX_NODE_BLOCK_SIZE,
+               align(0x18 + allocated_size, INDEX_NODE_BLOCK_SIZE))
+
+
+def index_blocks(buf, start=0, end=None):
+    """
+    A generator that yields each INDX record found in the given buffer,
+      such as a stream carved by INDXFind.py or an extracted
+      $INDEX_ALLOCATION attribute, as tuples of
+      (offset, IndexRecordHeader).
+
+    The buffer is never modified, so it may be a read-only mapping.
+      Each record is copied into a scratch buffer before its fixups
+      are applied, which means the offsets of the yielded header
+      and its entries are relative to the start of the record,
+      not the start of `buf`.
+    Blocks of all-null bytes are skipped.
+
+    Arguments:
+    - `buf`: Buffer containing one or more INDX records.
+    - `start`: The offset into the buffer at which to start walking.
+    - `end`: The offset into the buffer at which to stop walking.
+    Throws:
+    - `INDXException`: if a block is neither an INDX record nor null.
+    """
+    if end is None:
+        end = len(buf)
+
+    offset = start
+    while offset < end:
+        size = index_block_size(buf, offset)
+        if buf[offset:offset + 4] != "INDX":
+            if buf[offset:offset + size].strip("\x00"):
+                raise INDXException("Invalid INDX ID at beginning of block at %s, and non-null data encountered." % hex(offset))
+            logging.warning("Null block encountered at offset %s.", hex(offset))
+            offset += size
+            continue
+
+        block = array.array("B", buf[offset:offset + size])
+        yield offset, IndexRecordHeader(block, 0, None)
+        offset += size
+
+
 class INDEX_ALLOCATION(FixupBlock):
     def __init__(self, buf, offset, parent):
         """
@@ -620,10 +765,9 @@ class SlackIndexEntry(IndexEntry):
         """
         super(SlackIndexEntry, self).__init__(buf, offset, parent)
 
-    def is_valid(self):
+    def is_valid(self, future_date=SLACK_ENTRY_FUTURE_DATE):
         # this is a bit of a mess, but it should work
-        recent_date = datetime(1990, 1, 1, 0, 0, 0)
-        future_date = datetime(2025, 1, 1, 0, 0, 0)
+        recent_date = SLACK_ENTRY_RECENT_DATE
         try:
             fn = self.filename_information()
         except:
@@ -639,7 +783,8 @@ class SlackIndexEntry(IndexEntry):
                    fn.accessed_time() < future_date and \
                    fn.changed_time() < future_date and \
                    fn.created_time() < future_date
-        except ValueError:
+        except (ValueError, TypeError):
+            # TypeError: unset timestamps are parsed as None
             return False
 
 
@@ -668,6 +813,12 @@ class Runentry(Block, Nestable):
     def is_valid(self):
         return self._offset_length > 0 and self._length_length > 0
 
+    def is_sparse(self):
+        """
+        A run without an offset is sparse, and has no clusters allocated.
+        """
+        return self._offset_length == 0 and self._length_length > 0
+
     def lsb2num(self, binary):
         count = 0
         ret = 0
@@ -722,31 +873,106 @@ class Runlist(Block):
     def __len__(self):
         return sum(map(len, self._entries()))
 
-    def _entries(self, length=None):
+    def _entries(self, length=None, include_sparse=False):
         ret = []
         offset = self.offset()
         entry = Runentry(self._buf, offset, self)
         while entry.header() != 0 and \
               (not length or offset < self.offset() + length) and \
-              entry.is_valid():
+              (entry.is_valid() or (include_sparse and entry.is_sparse())):
             ret.append(entry)
             offset += len(entry)
             entry = Runentry(self._buf, offset, self)
         return ret
 
-    def runs(self, length=None):
+    def runs(self, length=None, include_sparse=False):
         """
         Yields tuples (volume offset, length).
         Recall that the entries are relative to one another
+
+        By default, the runs end at the first sparse run. If
+          `include_sparse` is True, then sparse runs are yielded
+          with a volume offset of None.
         """
         last_offset = 0
-        for e in self._entries(length=length):
+        for e in self._entries(length=length, include_sparse=include_sparse):
+            if e.is_sparse():
+                yield (None, e.length())
+                continue
             current_offset = last_offset + e.offset()
             current_length = e.length()
             last_offset = current_offset
             yield (current_offset, current_length)
 
 
+class RunlistReader(object):
+    """
+    RunlistReader reads ranges of the data of a non-resident attribute
+      from a volume, fetching only the clusters that overlap each range.
+      Sparse runs read as zeros.
+    """
+    def __init__(self, volume, runs, size, cluster_size, volume_offset=0):
+        """
+        Arguments:
+        - `volume`: A buffer containing the volume.
+        - `runs`: A sequence of (cluster offset, cluster count) tuples,
+            such as from `Runlist.runs`. The cluster offset of
+            a sparse run is None.
+        - `size`: The size of the data, in bytes.
+        - `cluster_size`: The size of a cluster, in bytes.
+        - `volume_offset`: The offset of the volume within `volume`,
+            such as for a disk image, in bytes.
+        """
+        super(RunlistReader, self).__init__()
+        self._volume = volume
+        self._size = size
+        # list of (data offset, volume offset or None, length), in bytes
+        self._extents = []
+        data_offset = 0
+        for cluster_offset, cluster_count in runs:
+            length = cluster_count * cluster_size
+            if cluster_offset is None:
+                self._extents.append((data_offset, None, length))
+            else:
+                self._extents.append((data_offset,
+                                      volume_offset + cluster_offset * cluster_size,
+                                      length))
+            data_offset += length
+        self._starts = [e[0] for e in self._extents]
+
+    def size(self):
+        return self._size
+
+    def read(self, offset, length):
+        """
+        Read up to `length` bytes of the data, starting at `offset`.
+        Data beyond the end of the runs reads as zeros.
+
+        @rtype: str
+        """
+        end = min(offset + length, self._size)
+        chunks = []
+        i = max(bisect.bisect_right(self._starts, offset) - 1, 0)
+        while offset < end:
+            if i >= len(self._extents):
+                chunks.append("\x00" * (end - offset))
+                break
+            data_offset, volume_offset, extent_length = self._extents[i]
+            extent_end = data_offset + extent_length
+            if offset >= extent_end:
+                i += 1
+                continue
+            count = min(end, extent_end) - offset
+            if volume_offset is None:
+                chunks.append("\x00" * count)
+            else:
+                start = volume_offset + (offset - data_offset)
+                chunks.append(self._volume[start:start + count])
+            offset += count
+            i += 1
+        return "".join(chunks)
+
+
 class ATTR_TYPE:
     STANDARD_INFORMATION = 0x10
     FILENAME_INFORMATION = 0x30
@@ -890,6 +1116,17 @@ class MFTRecord(FixupBlock):
 
         self.fixup(self.usa_count(), self.usa_offset())
 
+    def identity(self):
+        """
+        Get a cheap identity for the record, suitable as a cache key:
+          its record number and sequence number.
+        The record number is the inode given to the constructor,
+          if any, since the header field is zero before Windows XP.
+
+        @rtype: (int, int)
+        """
+        return (self.inode, read_word(self._buf, self.offset() + 0x10))
+
     def attributes(self):
         offset = self.attrs_offset()
 
@@ -943,14 +1180,25 @@ class MFTRecord(FixupBlock):
         except AttributeError:
             return None
 
-    def data_attribute(self):
+    def data_attribute(self, name=""):
         """
         Returns None if the default $DATA attribute does not exist
+
+        Arguments:
+        - `name`: The name of an alternate data stream to get instead.
         """
         for attr in self.attributes():
-            if attr.type() == ATTR_TYPE.DATA and attr.name() == "":
+            if attr.type() == ATTR_TYPE.DATA and attr.name() == name:
                 return attr
 
+    def data_stream_names(self):
+        """
+        Returns the names of the alternate data streams of the record.
+        @rtype: list of str
+        """
+        return [attr.name() for attr in self.attributes()
+                if attr.type() == ATTR_TYPE.DATA and attr.name() != ""]
+
     def slack_data(self):
         """
         Returns A binary string containing the MFT record slack.
@@ -1074,9 +1322,10 @@ class NTFSFile():
         return MFTRecord(buf, 0, False)
 
     # memoization is key here.
-    @memoize(100, keyfunc=lambda r, _:
-             str(r.magic()) + str(r.lsn()) + str(r.link_count()) + \
-             str(r.mft_record_number()) + str(r.flags()))
+    @memoize(100, keyfunc=lambda r, _=None:
+             (r.magic(), r.lsn(), r.link_count(),
+              r.mft_record_number(), r.flags()),
+             threadsafe=True)
     def mft_record_build_path(self, record, cycledetector=None):
         if cycledetector is None:
             cycledetector = {}
@@ -1139,6 +1388,7 @@ class InvalidAttributeException(INDXException):
 
 class InvalidMFTRecordNumber(Exception):
     def __init__(self, value):
+        super(InvalidMFTRecordNumber, self).__init__(value)
         self.value = value
 
 
@@ -1160,54 +1410,93 @@ class InvalidRecordException(Exception):
         return "InvalidRecordException(%s)" % (self._msg)
 
 
-class Cache(object):
-    def __init__(self, size_limit):
-        super(Cache, self).__init__()
-        self._c = OrderedDict()
-        self._size_limit = size_limit
+MFT_RECORD_SIZE = 1024
+FILE_SEP = "\\"
+UNKNOWN_ENTRY = "??"
+ORPHAN_ENTRY = "$ORPHAN"
+CYCLE_ENTRY = "<CYCLE>"
 
-    def insert(self, k, v):
-        """
-        add a key and value to the front
-        """
-        self._c[k] = v
-        if len(self._c) > self._size_limit:
-            self._c.popitem(last=False)
+# number of records whose paths MFTEnumerator.enumerate_paths resolves at once
+PATH_BATCH_SIZE = 1024
 
-    def exists(self, k):
-        return k in self._c
+# default capacity of the record and path caches of an MFTEnumerator
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+# estimated memory used by a parsed MFTRecord beyond its buffer
+RECORD_OVERHEAD = 1024
 
-    def touch(self, k):
-        """
-        bring a key to the front
-        """
-        v = self._c[k]
-        del self._c[k]
-        self._c[k] = v
 
-    def get(self, k):
-        return self._c[k]
+def record_sizeof(record):
+    """
+    Estimate the memory used by a cached MFTRecord.
+    """
+    return sys.getsizeof(record._buf) + RECORD_OVERHEAD
 
 
-MFT_RECORD_SIZE = 1024
-FILE_SEP = "\\"
-UNKNOWN_ENTRY = "??"
-ORPHAN_ENTRY = "$ORPHAN"
-CYCLE_ENTRY = "<CYCLE>"
+def path_sizeof(path):
+    return sys.getsizeof(path)
+
+
+def new_record_cache(size_limit=DEFAULT_CACHE_SIZE, threadsafe=False):
+    """
+    Create a cache for MFTRecords with a capacity in bytes.
+    Use `threadsafe` when an MFTEnumerator is shared by threads.
+    """
+    return Cache(size_limit, sizeof=record_sizeof, threadsafe=threadsafe)
+
+
+def new_path_cache(size_limit=DEFAULT_CACHE_SIZE, threadsafe=False):
+    """
+    Create a cache for record paths with a capacity in bytes.
+    Use `threadsafe` when an MFTEnumerator is shared by threads.
+    """
+    return Cache(size_limit, sizeof=path_sizeof, threadsafe=threadsafe)
+
+
+# unsuffixed cache sizes below this are taken as a number of records,
+#   which is what the cache size options once meant
+LEGACY_CACHE_COUNT_LIMIT = 64 * 1024
+
+
+def parse_cache_size(s):
+    """
+    Parse a cache size in bytes, with an optional K, M, or G suffix,
+      as given on the command line.
+
+    The cache size options used to be a number of entries, such as
+      the old default of 1024. An unsuffixed value below
+      LEGACY_CACHE_COUNT_LIMIT is still read as a number of records,
+      converted to the bytes they would use, and a warning is printed.
+
+    @raise ValueError: if the size is malformed.
+    """
+    size = parse_size(s)
+    if s.strip()[-1:].isdigit() and size < LEGACY_CACHE_COUNT_LIMIT:
+        count = size
+        size = count * (MFT_RECORD_SIZE + RECORD_OVERHEAD)
+        sys.stderr.write("%s: warning: cache size %d has no unit, so it is "
+                         "read as %d records (%d bytes); give a size in "
+                         "bytes with a K, M, or G suffix instead\n" %
+                         (os.path.basename(sys.argv[0]), count, count, size))
+    return size
 
 
 class MFTEnumerator(object):
     def __init__(self, buf, record_cache=None, path_cache=None):
-        DEFAULT_CACHE_SIZE = 1024
         if record_cache is None:
-            record_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
+            record_cache = new_record_cache()
         if path_cache is None:
-            path_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
+            path_cache = new_path_cache()
 
         self._buf = buf
         self._record_cache = record_cache
         self._path_cache = path_cache
 
+    def record_cache(self):
+        return self._record_cache
+
+    def path_cache(self):
+        return self._path_cache
+
     def len(self):
         return len(self._buf) / MFT_RECORD_SIZE
 
@@ -1227,18 +1516,15 @@ class MFTEnumerator(object):
         @raises OverrunBufferException: if the record_num is beyond the end of the MFT.
         @raises InvalidRecordException: if the record appears invalid (incorrect magic header).
         """
-        if self._record_cache.exists(record_num):
-            self._record_cache.touch(record_num)
-            return self._record_cache.get(record_num)
-
+        return self._record_cache.get_or_load(record_num,
+                                              lambda: self._load_record(record_num))
 
+    def _load_record(self, record_num):
         record_buf = self.get_record_buf(record_num)
         if read_dword(record_buf, 0x0) != 0x454C4946:
             raise InvalidRecordException("record_num: %d" % record_num)
 
-        record = MFTRecord(record_buf, 0, False, inode=record_num)
-        self._record_cache.insert(record_num, record)
-        return record
+        return MFTRecord(record_buf, 0, False, inode=record_num)
 
     def enumerate_records(self):
         index = 0
@@ -1256,9 +1542,29 @@ class MFTEnumerator(object):
                 continue
 
     def enumerate_paths(self):
+        batch = []
         for record in self.enumerate_records():
-            path = self.get_path(record)
-            yield record, path
+            batch.append(record)
+            if len(batch) == PATH_BATCH_SIZE:
+                for pair in zip(batch, self.get_paths(batch)):
+                    yield pair
+                batch = []
+        for pair in zip(batch, self.get_paths(batch)):
+            yield pair
+
+    def get_paths(self, records):
+        """
+        Resolve the paths of many records at once. The paths of the
+          ancestors resolved along the way are shared by the whole batch,
+          even if they would be evicted from the path cache.
+
+        @type records: sequence of MFTRecord
+        @rtype: list of str
+        @return: The paths of the records, in order. See `get_path`.
+        """
+        resolved = {}
+        return [self._get_path_impl(record, set(), resolved)
+                for record in records]
 
     def get_path(self, record):
         """
@@ -1273,20 +1579,26 @@ class MFTEnumerator(object):
         """
         return self._get_path_impl(record, set())
 
-    def _get_path_impl(self, record, cycledetector):
+    def _get_path_impl(self, record, cycledetector, resolved=None):
         """
         @type cycledetector: set of int
         @param cycledetector: A set of numbers that describe which records have been processed
           in the building of the path.
+        @type resolved: dict of (int, int) to str, or None
+        @param resolved: Paths already resolved in this batch, by record identity.
         """
-        key = "%d-%d-%d-%d-%d" % (record.magic(), record.lsn(),
-                                  record.link_count(), record.mft_record_number(),
-                                  record.flags())
-        if self._path_cache.exists(key):
-            self._path_cache.touch(key)
+        key = record.identity()
+        if resolved is not None:
+            try:
+                return resolved[key]
+            except KeyError:
+                pass
+        try:
             return self._path_cache.get(key)
+        except KeyError:
+            pass
 
-        record_num = record.mft_record_number()
+        record_num = key[0]
         if record_num == 5:
             return ""
 
@@ -1312,8 +1624,11 @@ class MFTEnumerator(object):
         if parent_record.sequence_number() != parent_seq_num:
             return ORPHAN_ENTRY + FILE_SEP + record_filename
 
-        path = self._get_path_impl(parent_record, cycledetector) + FILE_SEP + record_filename
+        path = self._get_path_impl(parent_record, cycledetector, resolved) + \
+            FILE_SEP + record_filename
         self._path_cache.insert(key, path)
+        if resolved is not None:
+            resolved[key] = path
         return path
 
     def get_record_by_path(self, path):
@@ -1332,6 +1647,7 @@ class MFTTreeNode(object):
         self._filename = filename
         self._parent_record_number = parent_record_number
         self._children_record_numbers = []
+        self._children_by_filename = {}
 
     def get_record_number(self):
         return self._record_number
@@ -1344,15 +1660,21 @@ class MFTTreeNode(object):
 
     def add_child_record_number(self, child_record_number):
         self._children_record_numbers.append(child_record_number)
+        filename = self._nodes[child_record_number].get_filename()
+        self._children_by_filename.setdefault(filename, child_record_number)
 
     def get_children_nodes(self):
         return map(lambda n: self._nodes[n], self._children_record_numbers)
 
+    def get_children_filenames(self):
+        return [self._nodes[n].get_filename()
+                for n in self._children_record_numbers]
+
     def get_child_node(self, filename):
-        for child in self.get_children_nodes():
-            if child.get_filename() == filename:
-                return child
-        raise KeyError("Failed to find filename: " + filename)
+        try:
+            return self._nodes[self._children_by_filename[filename]]
+        except KeyError:
+            raise KeyError("Failed to find filename: " + filename)
 
 
 ROOT_INDEX = 5
@@ -1411,13 +1733,15 @@ class MFTTree(object):
             parent_node.add_child_record_number(record_num)
 
     def build(self, record_cache=None,
-              path_cache=None, progress_class=NullProgress):
-        DEFAULT_CACHE_SIZE = 1024
-        if record_cache is None:
-            record_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
-        if path_cache is None:
-            path_cache = Cache(size_limit=DEFAULT_CACHE_SIZE)
+              path_cache=None, progress_class=NullProgress, callback=None):
+        """
+        Add all the records of the MFT to the tree.
 
+        Arguments:
+        - `callback`: If provided, a function that is called with each
+            record as it is enumerated, such as to precompute per-record
+            data while the record is parsed anyway.
+        """
         enum = MFTEnumerator(self._buf, record_cache=record_cache, path_cache=path_cache)
 
         self._nodes[MFTTree.ORPHAN_INDEX] = MFTTreeNode(self._nodes, MFTTree.ORPHAN_INDEX,
@@ -1427,9 +1751,431 @@ class MFTTree(object):
         progress = progress_class(len(self._buf) / 1024)
         for record in enum.enumerate_records():
             self._add_record(enum, record)
+            if callback is not None:
+                callback(record)
             count += 1
             progress.set_current(count)
         progress.set_complete()
 
     def get_root(self):
         return self._nodes[ROOT_INDEX]
+
+
+# the type and length fields of an attribute header
+ATTRIBUTE_HEADER_STRUCT = struct.Struct("<II")
+
+# the parent reference and filename namespace of a $FILE_NAME value
+FILENAME_PARENT_STRUCT = struct.Struct("<Q57xB")
+
+# the fixups of an MFT record replace the final word of its first sector
+MFT_RECORD_FIRST_FIXUP_OFFSET = 0x1FE
+
+
+class LazyMFTTreeNode(MFTTreeNode):
+    """
+    A node of a LazyMFTTree, whose children are only found
+      once they are first requested.
+    """
+    def __init__(self, tree, record_number, filename, parent_record_number):
+        super(LazyMFTTreeNode, self).__init__(tree._nodes, record_number,
+                                              filename, parent_record_number)
+        self._tree = tree
+        self._children_loaded = False
+
+    def _load_children(self):
+        if self._children_loaded:
+            return
+        with self._tree._lock:
+            if self._children_loaded:
+                return
+            for child_record_number in self._tree._find_children(self._record_number):
+                self.add_child_record_number(child_record_number)
+            # only set once the children are complete, so that readers
+            #   need not take the lock
+            self._children_loaded = True
+
+    def get_parent(self):
+        return self._tree.get_node(self._parent_record_number)
+
+    def get_children_nodes(self):
+        self._load_children()
+        return super(LazyMFTTreeNode, self).get_children_nodes()
+
+    def get_children_filenames(self):
+        self._load_children()
+        return super(LazyMFTTreeNode, self).get_children_filenames()
+
+    def get_child_node(self, filename):
+        self._load_children()
+        return super(LazyMFTTreeNode, self).get_child_node(filename)
+
+
+class LazyMFTTree(object):
+    """
+    A tree of the records of an MFT, with the same interface as MFTTree,
+      that is built as directories are listed rather than up front.
+
+    The children of a directory are found using a map from parent to
+      children record numbers that is built by a single scan of the MFT
+      the first time a directory is listed. The scan only reads the
+      record headers and parent references, rather than parsing each
+      record. The $I30 indexes are not used, since they omit the deleted
+      and unindexed records that MFTTree places in each directory.
+
+    The tree may be shared by threads, provided that the caches are
+      thread-safe, too.
+    """
+    def __init__(self, buf, record_cache=None, path_cache=None):
+        super(LazyMFTTree, self).__init__()
+        self._buf = buf
+        # serializes the loading of children and of the children index
+        self._lock = threading.RLock()
+        self._enumerator = MFTEnumerator(buf, record_cache=record_cache,
+                                         path_cache=path_cache)
+        self._nodes = {}
+        self._children_index = None
+
+        self._nodes[ROOT_INDEX] = LazyMFTTreeNode(self, ROOT_INDEX, "\.", ROOT_INDEX)
+        self._nodes[MFTTree.ORPHAN_INDEX] = LazyMFTTreeNode(self, MFTTree.ORPHAN_INDEX,
+                                                            ORPHAN_ENTRY, ROOT_INDEX)
+
+    def get_root(self):
+        return self._nodes[ROOT_INDEX]
+
+    def get_node(self, record_number):
+        """
+        Get the node of the record with the given number, whose
+          parent has already been listed.
+        """
+        return self._nodes[record_number]
+
+    def _add_node(self, record_number, parent_record_number):
+        """
+        Create the node for a record, unless it already exists.
+
+        @rtype: LazyMFTTreeNode
+        @return: The node, or None if the record has no filename.
+        """
+        try:
+            return self._nodes[record_number]
+        except KeyError:
+            pass
+
+        fn = self._enumerator.get_record(record_number).filename_information()
+        if not fn:
+            return None
+        node = LazyMFTTreeNode(self, record_number, fn.filename(),
+                               parent_record_number)
+        self._nodes[record_number] = node
+        return node
+
+    def _find_children(self, record_number):
+        """
+        Get the record numbers of the children of the given directory,
+          creating their nodes.
+
+        @rtype: list of int
+        """
+        ret = []
+        for child_record_number in self._get_children_index().get(record_number, []):
+            if child_record_number in (ROOT_INDEX, MFTTree.ORPHAN_INDEX):
+                continue
+            try:
+                node = self._add_node(child_record_number, record_number)
+            except (OverrunBufferException, InvalidRecordException):
+                continue
+            if node is not None:
+                ret.append(child_record_number)
+        return ret
+
+    def _parent_record_number(self, record):
+        """
+        Get the number of the parent of the given record, in the same
+          way as MFTTree does, including orphans.
+
+        @rtype: int
+        @return: The parent record number, or None if the record has no filename.
+        """
+        fn = record.filename_information()
+        if not fn:
+            return None
+        return self._check_parent_reference(fn.mft_parent_reference())
+
+    def _check_parent_reference(self, parent_reference):
+        """
+        Get the record number of a parent reference, or the orphan
+          record number if it refers to a missing or reused record.
+        """
+        parent_record_num = MREF(parent_reference)
+        offset = parent_record_num * MFT_RECORD_SIZE
+        if offset + MFT_RECORD_SIZE > len(self._buf) or \
+           read_dword(self._buf, offset) != 0x454C4946 or \
+           read_word(self._buf, offset + 0x10) != MSEQNO(parent_reference):
+            return MFTTree.ORPHAN_INDEX
+        return parent_record_num
+
+    def _get_children_index(self):
+        if self._children_index is None:
+            self._children_index = self._build_children_index()
+        return self._children_index
+
+    def _build_children_index(self):
+        """
+        Map each directory record number to the record numbers of
+          its children, by scanning the parent references of all records.
+
+        @rtype: dict of int to list of int
+        """
+        buf = self._buf
+        index = {}
+        record_number = 0
+        while (record_number + 1) * MFT_RECORD_SIZE <= len(buf):
+            if record_number == 12:  # reserved records are 12-15
+                record_number = 16
+                continue
+
+            parent_reference = self._scan_parent_reference(record_number)
+            if parent_reference is not None and record_number != ROOT_INDEX:
+                parent_record_num = self._check_parent_reference(parent_reference)
+                index.setdefault(parent_record_num, []).append(record_number)
+            record_number += 1
+        return index
+
+    def _scan_parent_reference(self, record_number):
+        """
+        Get the parent reference of the filename attribute of a record
+          that MFTRecord.filename_information would choose, reading only
+          the attribute headers from the raw MFT.
+
+        @rtype: int
+        @return: The parent reference, or None if the record is
+          invalid or has no filename.
+        """
+        buf = self._buf
+        offset = record_number * MFT_RECORD_SIZE
+        if read_dword(buf, offset) != 0x454C4946:
+            return None
+
+        bytes_in_use = min(read_dword(buf, offset + 0x18), MFT_RECORD_SIZE)
+        attr_offset = read_word(buf, offset + 0x14)
+        parent_reference = None
+        while attr_offset + ATTRIBUTE_HEADER_STRUCT.size <= bytes_in_use:
+            attr_type, attr_length = ATTRIBUTE_HEADER_STRUCT.unpack_from(buf, offset + attr_offset)
+            if attr_type == 0 or attr_type == 0xFFFFFFFF or attr_length == 0 or \
+               attr_offset + attr_length > bytes_in_use:
+                break
+
+            if attr_type == ATTR_TYPE.FILENAME_INFORMATION and \
+               read_byte(buf, offset + attr_offset + 0x8) == 0:
+                value_offset = attr_offset + read_word(buf, offset + attr_offset + 0x14)
+                if value_offset <= MFT_RECORD_FIRST_FIXUP_OFFSET < \
+                   value_offset + FILENAME_PARENT_STRUCT.size:
+                    # the fields straddle a fixup, so parse the record
+                    try:
+                        fn = self._enumerator.get_record(record_number).filename_information()
+                    except (OverrunBufferException, InvalidRecordException):
+                        return None
+                    if not fn:
+                        return None
+                    return fn.mft_parent_reference()
+
+                if value_offset + FILENAME_PARENT_STRUCT.size > bytes_in_use:
+                    break
+                parent_reference, filename_type = \
+                    FILENAME_PARENT_STRUCT.unpack_from(buf, offset + value_offset)
+                if filename_type == 0x0001 or filename_type == 0x0003:
+                    return parent_reference
+
+            attr_offset += attr_length
+        return parent_reference
+
+
+def _test_resident_attribute(type_, value, name=u""):
+    name = name.encode("utf-16le")
+    value_offset = align(0x18 + len(name), 8)
+    size = align(value_offset + len(value), 8)
+    ret = bytearray(size)
+    struct.pack_into("<IIBBHHHIHBB", ret, 0, type_, size, 0, len(name) / 2,
+                     0x18, 0, 0, len(value), value_offset, 0, 0)
+    ret[0x18:0x18 + len(name)] = name
+    ret[value_offset:value_offset + len(value)] = value
+    return str(ret)
+
+
+def _test_filename_value(parent_reference, name, timestamp):
+    return struct.pack("<QQQQQQQIIBB", parent_reference,
+                       timestamp, timestamp, timestamp, timestamp,
+                       100, 100, 0x20, 0, len(name), 1) + name.encode("utf-16le")
+
+
+def _test_mft_record(number, sequence, flags, name, parent_reference, children=()):
+    """
+    Build a 1024 byte MFT record with $STANDARD_INFORMATION, $FILE_NAME,
+      and, if `children` is given, a resident $I30 index of the
+      (record number, sequence number, filename) tuples.
+    """
+    timestamp = 129067776000000000  # 2010-01-01
+    attributes = [
+        _test_resident_attribute(ATTR_TYPE.STANDARD_INFORMATION,
+                                 struct.pack("<QQQQI12xIIQQ", timestamp, timestamp,
+                                             timestamp, timestamp, 0x20, 0, 0, 0, 0)),
+        _test_resident_attribute(ATTR_TYPE.FILENAME_INFORMATION,
+                                 _test_filename_value(parent_reference, name, timestamp)),
+    ]
+    if children:
+        entries = []
+        for child_number, child_sequence, child_name in children:
+            value = _test_filename_value((sequence << 48) | number, child_name, timestamp)
+            length = align(0x10 + len(value), 8)
+            entry = struct.pack("<QHHI", (child_sequence << 48) | child_number,
+                                length, len(value), 0) + value
+            entries.append(entry + "\x00" * (length - len(entry)))
+        entries.append(struct.pack("<QHHI", 0, 0x10, 0, INDEX_ENTRY_FLAGS.INDEX_ENTRY_END))
+        body = "".join(entries)
+        index_root = struct.pack("<IIIB3xIIIB3x", ATTR_TYPE.FILENAME_INFORMATION, 1,
+                                 4096, 1, 0x10, 0x10 + len(body), 0x10 + len(body), 0)
+        attributes.append(_test_resident_attribute(ATTR_TYPE.INDEX_ROOT,
+                                                   index_root + body, name=u"$I30"))
+
+    buf = bytearray(MFT_RECORD_SIZE)
+    buf[0:4] = "FILE"
+    struct.pack_into("<HHQHHHHII", buf, 4, 0x30, 3, 0, sequence, 1, 0x38,
+                     flags, 0, MFT_RECORD_SIZE)
+    struct.pack_into("<I", buf, 0x2C, number)
+    offset = 0x38
+    for attribute in attributes:
+        buf[offset:offset + len(attribute)] = attribute
+        offset += len(attribute)
+    struct.pack_into("<I", buf, offset, 0xFFFFFFFF)
+    struct.pack_into("<I", buf, 0x18, offset + 8)
+
+    # the update sequence array at 0x30, with one fixup per sector
+    buf[0x30:0x32] = "\x01\x00"
+    for i in xrange(1, 3):
+        end = 512 * i
+        buf[0x30 + 2 * i:0x32 + 2 * i] = buf[end - 2:end]
+        buf[end - 2:end] = "\x01\x00"
+    return str(buf)
+
+
+def _test_mft():
+    """
+    Build a small MFT:
+
+        \\docs           (16, a directory with a resident $I30 index)
+        \\docs\\a.txt     (17)
+        \\docs\\b.txt     (18)
+        \\docs\\old.txt   (19, deleted, and missing from the index)
+        \\lost.txt       (20, its parent has been reused)
+    """
+    records = ["\x00" * MFT_RECORD_SIZE] * 21
+    records[ROOT_INDEX] = _test_mft_record(ROOT_INDEX, 5, 0x3, u".",
+                                           (5 << 48) | ROOT_INDEX,
+                                           children=[(16, 1, u"docs")])
+    records[16] = _test_mft_record(16, 1, 0x3, u"docs", (5 << 48) | ROOT_INDEX,
+                                   children=[(17, 1, u"a.txt"), (18, 1, u"b.txt")])
+    records[17] = _test_mft_record(17, 1, 0x1, u"a.txt", (1 << 48) | 16)
+    records[18] = _test_mft_record(18, 1, 0x1, u"b.txt", (1 << 48) | 16)
+    records[19] = _test_mft_record(19, 2, 0x0, u"old.txt", (1 << 48) | 16)
+    records[20] = _test_mft_record(20, 1, 0x1, u"lost.txt", (7 << 48) | 16)
+    return "".join(records)
+
+
+def test():
+    import copy
+    import pickle
+    import shutil
+    import tempfile
+
+    buf = _test_mft()
+
+    # memoized methods keep their caches out of the instance state
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "mft.bin")
+        with open(filename, "wb") as f:
+            f.write(buf)
+        ntfsfile = NTFSFile({"filename": filename, "filetype": "mft",
+                             "offset": 0, "clustersize": 4096,
+                             "prefix": None, "progress": False})
+        record = ntfsfile.mft_get_record(17)
+        assert ntfsfile.mft_record_build_path(record, {}) == "\\.\\docs\\a.txt"
+        assert ntfsfile.mft_record_build_path.cache_info()["misses"] == 3
+
+        for protocol in (0, 2):
+            clone = pickle.loads(pickle.dumps(ntfsfile, protocol))
+            assert clone.mft_record_build_path.cache_info()["misses"] == 0
+            assert clone.mft_record_build_path(record, {}) == "\\.\\docs\\a.txt"
+
+        clone = copy.copy(ntfsfile)
+        assert clone.mft_record_build_path.cache_info()["misses"] == 0
+        clone.prefix = "\\\\?"
+        assert clone.mft_record_build_path(record, {}) == "\\\\?\\docs\\a.txt"
+        assert ntfsfile.mft_record_build_path(record, {}) == "\\.\\docs\\a.txt"
+        assert ntfsfile.mft_record_build_path.cache_info()["hits"] == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+    # the lazy tree places the same records in each directory as the full tree,
+    #   including deleted records that are missing from the $I30 index
+    def children(node):
+        return sorted((n.get_record_number(), n.get_filename())
+                      for n in node.get_children_nodes())
+
+    tree = MFTTree(buf)
+    tree.build()
+    lazy_tree = LazyMFTTree(buf)
+    for record_number in (ROOT_INDEX, 16, MFTTree.ORPHAN_INDEX):
+        if record_number == 16:
+            lazy_tree.get_root().get_children_nodes()
+        assert children(tree._nodes[record_number]) == \
+            children(lazy_tree.get_node(record_number))
+    assert children(lazy_tree.get_node(16)) == \
+        [(17, "a.txt"), (18, "b.txt"), (19, "old.txt")]
+    assert children(lazy_tree.get_node(MFTTree.ORPHAN_INDEX)) == [(20, "lost.txt")]
+
+    # parse errors survive pickling, so that a worker process, such as
+    #   those of INDXParse --jobs, reports the same error as a serial run
+    for e in (INDXException("x"), InvalidAttributeException("x"),
+              ParseException("x"), OverrunBufferException(4, 8)):
+        clone = pickle.loads(pickle.dumps(e, 2))
+        assert type(clone) is type(e) and str(clone) == str(e)
+
+    malformed = "\x01" * INDEX_NODE_BLOCK_SIZE
+    try:
+        list(index_blocks(malformed))
+        assert False
+    except INDXException as e:
+        expected = str(e)
+    import multiprocessing
+    pool = multiprocessing.Pool(1)
+    try:
+        pool.apply_async(_test_index_blocks_worker, (malformed, )).get(timeout=60)
+        assert False
+    except INDXException as e:
+        assert str(e) == expected
+    finally:
+        pool.terminate()
+        pool.join()
+
+    # small unsuffixed cache sizes are legacy record counts
+    from StringIO import StringIO
+    assert parse_cache_size("16M") == 16 * 1024 * 1024
+    assert parse_cache_size("65536") == 65536
+    stderr, sys.stderr = sys.stderr, StringIO()
+    try:
+        assert parse_cache_size("1024") == \
+            1024 * (MFT_RECORD_SIZE + RECORD_OVERHEAD)
+        assert "warning" in sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+    return True
+
+
+def _test_index_blocks_worker(buf):
+    return len(list(index_blocks(buf)))
+
+
+if __name__ == "__main__":
+    if test():
+        print "MFT passed tests."
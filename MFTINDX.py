@@ -23,6 +23,8 @@ from BinaryParser import info
 from BinaryParser import warning
 from BinaryParser import debug
 from BinaryParser import error
+from Output import add_output_arguments
+from Output import open_output_from_args
 import calendar
 
 verbose = False
@@ -204,15 +206,7 @@ def record_indx_entries_bodyfile(options, ntfsfile, record):
     return ret
 
 
-def try_write(s):
-    try:
-        sys.stdout.write(s)
-    except (UnicodeEncodeError, UnicodeDecodeError):
-        warning("Failed to write string "
-                "due to encoding issue: " + str(list(s)))
-
-
-def print_nonresident_indx_bodyfile(options, buf, basepath=""):
+def print_nonresident_indx_bodyfile(options, output, buf, basepath=""):
     offset = 0
     try:
         irh = IndexRecordHeader(buf, offset, False)
@@ -221,7 +215,7 @@ def print_nonresident_indx_bodyfile(options, buf, basepath=""):
     # TODO could miss something if there is an empty, valid record at the end
     while irh.magic() == 0x58444E49:
         nh = irh.node_header()
-        try_write(node_header_bodyfile(options, nh, basepath))
+        output.write(node_header_bodyfile(options, nh, basepath))
         offset += options.clustersize
         if offset + 4096 > len(buf):  # TODO make this INDX record size
             return
@@ -232,7 +226,7 @@ def print_nonresident_indx_bodyfile(options, buf, basepath=""):
     return
 
 
-def print_bodyfile(options):
+def print_bodyfile(options, output):
     if options.filetype == "mft" or options.filetype == "image":
         f = NTFSFile(options)
         if options.filter:
@@ -250,12 +244,12 @@ def print_bodyfile(options):
                               "due to regex filter: " + path)
                         continue
                 if record.is_active() and options.mftlist:
-                    try_write(record_bodyfile(f, record))
+                    output.write(record_bodyfile(f, record))
                 if options.indxlist or options.slack:
-                    try_write(record_indx_entries_bodyfile(options, f, record))
+                    output.write(record_indx_entries_bodyfile(options, f, record))
                 elif (not record.is_active()) and options.deleted:
-                    try_write(record_bodyfile(f, record,
-                                              attributes=["deleted"]))
+                    output.write(record_bodyfile(f, record,
+                                                 attributes=["deleted"]))
                 if options.filetype == "image" and \
                    (options.indxlist or options.slack):
                     extractbuf = array.array("B")
@@ -273,7 +267,7 @@ def print_bodyfile(options):
                             pass  # This shouldn't happen.
                     if found_indxalloc and len(extractbuf) > 0:
                         path = f.mft_record_build_path(record, {})
-                        print_nonresident_indx_bodyfile(options,
+                        print_nonresident_indx_bodyfile(options, output,
                                                         extractbuf,
                                                         basepath=path)
             except InvalidAttributeException:
@@ -281,7 +275,7 @@ def print_bodyfile(options):
     elif options.filetype == "indx":
         with open(options.filename, "rb") as f:
             buf = array.array("B", f.read())
-        print_nonresident_indx_bodyfile(options, buf)
+        print_nonresident_indx_bodyfile(options, output, buf)
 
 
 def print_indx_info(options):
@@ -554,6 +548,7 @@ def main():
                         "if STDOUT is redirected")
     parser.add_argument('-v', action="store_true", dest="verbose",
                         help="Print debugging information")
+    add_output_arguments(parser)
     parser.add_argument('filename', action="store",
                         help="Input INDX file path")
 
@@ -670,7 +665,11 @@ def main():
          results.slack or \
          results.mftlist or \
          results.deleted:
-        print_bodyfile(results)
+        # open the input first, so that a bad input path does not
+        #   truncate an existing output file
+        with open(results.filename, "rb"), \
+             open_output_from_args(results) as output:
+            print_bodyfile(results, output)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+#    This file is part of INDXParse.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import bz2
+import sys
+import gzip
+
+
+# number of characters to collect before each write to the output file
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+DEFAULT_ENCODING = "utf-8"
+DEFAULT_ERRORS = "replace"
+ENCODING_ERRORS = ["strict", "replace", "ignore",
+                   "backslashreplace", "xmlcharrefreplace"]
+
+
+class OutputSink(object):
+    """
+    A buffered writer of text output, such as the lines of a bodyfile.
+    Strings are collected until OUTPUT_BUFFER_SIZE characters are
+      pending, and then encoded and written with a single call,
+      so the cost of writing does not grow with the number of lines.
+    Characters that cannot be encoded are handled according to the
+      `errors` policy of `unicode.encode`, rather than by the caller.
+    """
+    def __init__(self, f, encoding=DEFAULT_ENCODING, errors=DEFAULT_ERRORS,
+                 close_file=False, buffer_size=OUTPUT_BUFFER_SIZE):
+        """
+        Arguments:
+        - `f`: The file-like object to which to write bytes.
+        - `encoding`: The encoding of unicode strings.
+        - `errors`: The policy for characters that cannot be encoded.
+        - `close_file`: If True, then `close` also closes `f`.
+        - `buffer_size`: The number of characters to collect before writing.
+        """
+        super(OutputSink, self).__init__()
+        self._f = f
+        self._encoding = encoding
+        self._errors = errors
+        self._close_file = close_file
+        self._buffer_size = buffer_size
+        self._pieces = []
+        self._pending = 0
+
+    def write(self, s):
+        """
+        Write a string, or a unicode string, to the output.
+        """
+        self._pieces.append(s)
+        self._pending += len(s)
+        if self._pending >= self._buffer_size:
+            self.flush()
+
+    def write_line(self, s):
+        """
+        Write a string to the output, followed by a newline.
+        """
+        self.write(s)
+        self.write("\n")
+
+    def flush(self):
+        """
+        Write any pending output to the file. The file itself is not
+          flushed until `close`, since each flush of a gzip file
+          ends its compressed block early.
+        """
+        if self._pieces:
+            try:
+                data = u"".join(self._pieces).encode(self._encoding, self._errors)
+            except UnicodeDecodeError:
+                # byte strings that are not ASCII are written as they are
+                data = "".join(p.encode(self._encoding, self._errors)
+                               if isinstance(p, unicode) else p
+                               for p in self._pieces)
+            self._pieces = []
+            self._pending = 0
+            self._f.write(data)
+
+    def close(self):
+        """
+        Write any pending output, and close the file if it is owned
+          by this sink.
+        """
+        self.flush()
+        if self._close_file:
+            self._f.close()
+        else:
+            # such as STDOUT, which remains open
+            flush = getattr(self._f, "flush", None)
+            if flush is not None:
+                flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, traceback):
+        self.close()
+
+
+def open_output(filename=None, encoding=DEFAULT_ENCODING, errors=DEFAULT_ERRORS):
+    """
+    Create an OutputSink that writes to the given file, or to STDOUT.
+    The output is compressed if the filename ends with .gz or .bz2.
+
+    Arguments:
+    - `filename`: The path of the output file, or None or "-" for STDOUT.
+    - `encoding`: The encoding of unicode strings.
+    - `errors`: The policy for characters that cannot be encoded.
+    @rtype: OutputSink
+    """
+    if filename is None or filename == "-":
+        return OutputSink(sys.stdout, encoding, errors)
+    elif filename.endswith(".gz"):
+        return OutputSink(gzip.open(filename, "wb"), encoding, errors,
+                          close_file=True)
+    elif filename.endswith(".bz2"):
+        return OutputSink(bz2.BZ2File(filename, "wb"), encoding, errors,
+                          close_file=True)
+    else:
+        return OutputSink(open(filename, "wb"), encoding, errors,
+                          close_file=True)
+
+
+def add_output_arguments(parser):
+    """
+    Add the --output, --encoding, and --errors options to
+      an argparse.ArgumentParser, for use with `open_output_from_args`.
+    """
+    parser.add_argument('--output', action="store", metavar="path",
+                        dest="output", default=None,
+                        help="Write output to this file rather than STDOUT, "
+                        "compressed if the name ends with .gz or .bz2")
+    parser.add_argument('--encoding', action="store", metavar="encoding",
+                        dest="encoding", default=DEFAULT_ENCODING,
+                        help="Encoding of the output (default: %s)" %
+                        (DEFAULT_ENCODING))
+    parser.add_argument('--errors', action="store", choices=ENCODING_ERRORS,
+                        dest="errors", default=DEFAULT_ERRORS,
+                        help="How to handle characters that cannot be "
+                        "encoded (default: %s)" % (DEFAULT_ERRORS))
+
+
+def open_output_from_args(args):
+    """
+    Create an OutputSink from the options added by `add_output_arguments`.
+    @rtype: OutputSink
+    """
+    return open_output(args.output, args.encoding, args.errors)
@@ -18,6 +18,10 @@
 #   limitations under the License.
 #
 #   Version v.1.2
+import struct
+import logging
+from collections import namedtuple
+
 from BinaryParser import Block
 from BinaryParser import Nestable
 from BinaryParser import ParseException
@@ -25,6 +29,18 @@ from BinaryParser import align
 from BinaryParser import read_byte
 from BinaryParser import read_word
 from BinaryParser import read_dword
+from MFT import Cache
+from MFT import SII_INDEX_ENTRY
+from MFT import index_blocks
+
+
+# the same SIDs and ACEs appear in many descriptors, so their
+#  parsed forms are interned in these bounded caches,
+#  keyed by their raw bytes.
+SID_STRING_CACHE_SIZE = 4096
+ACE_SUMMARY_CACHE_SIZE = 4096
+g_sid_strings = Cache(SID_STRING_CACHE_SIZE)
+g_ace_summaries = Cache(ACE_SUMMARY_CACHE_SIZE)
 
 
 class NULL_OBJECT(object):
@@ -74,7 +90,7 @@ class SID_IDENTIFIER_AUTHORITY(Block, Nestable):
         return SID_IDENTIFIER_AUTHORITY.structure_size(self._buf, self.absolute_offset(0x0), None)
 
     def __str__(self):
-        return "%s" % (self.high_part() << 32 + self.low_part())
+        return "%s" % ((self.high_part() << 32) + self.low_part())
 
 
 class SID(Block, Nestable):
@@ -95,9 +111,17 @@ class SID(Block, Nestable):
         return self._off_sub_authorities + (self.sub_authority_count() * 4)
 
     def string(self):
+        key = self.unpack_binary(0, len(self))
+        try:
+            return g_sid_strings.get(key)
+        except KeyError:
+            pass
+
         ret = "S-%d-%s" % (self.revision(), self.identifier_authority())
         for sub_auth in self.sub_authorities():
             ret += "-%s" % (str(sub_auth))
+        ret = intern(ret)
+        g_sid_strings.insert(key, ret)
         return ret
 
 
@@ -128,6 +152,22 @@ class ACE_TYPES:
     ACCESS_MAX_MS_ACE_TYPE = 8
 
 
+ACE_TYPE_NAMES = {
+    ACE_TYPES.ACCESS_ALLOWED_ACE_TYPE: "allowed",
+    ACE_TYPES.ACCESS_DENIED_ACE_TYPE: "denied",
+    ACE_TYPES.SYSTEM_AUDIT_ACE_TYPE: "audit",
+    ACE_TYPES.SYSTEM_ALARM_ACE_TYPE: "alarm",
+    ACE_TYPES.ACCESS_ALLOWED_OBJECT_ACE_TYPE: "allowed-object",
+    ACE_TYPES.ACCESS_DENIED_OBJECT_ACE_TYPE: "denied-object",
+    ACE_TYPES.SYSTEM_AUDIT_OBJECT_ACE_TYPE: "audit-object",
+    ACE_TYPES.SYSTEM_ALARM_OBJECT_ACE_TYPE: "alarm-object",
+}
+
+
+# type is a name from ACE_TYPE_NAMES, and sid is the trustee SID string
+ACESummary = namedtuple("ACESummary", ["type", "flags", "access_mask", "sid"])
+
+
 class ACE_FLAGS:
     """
     One byte.
@@ -207,6 +247,28 @@ class ACE(Block):
         else:
             raise ParseException("unknown ACE type")
 
+    def summary(self):
+        """
+        Get the interned ACESummary tuple for this ACE.
+
+        @rtype: ACESummary
+        """
+        key = self.unpack_binary(0, self.unpack_word(0x2))
+        try:
+            return g_ace_summaries.get(key)
+        except KeyError:
+            pass
+
+        sid = None
+        if isinstance(self, (StandardACE, ObjectACE)):
+            sid = self.sid().string()
+        ret = ACESummary(ACE_TYPE_NAMES.get(self.ace_type(), self.ace_type()),
+                         self.ace_flags(),
+                         self.unpack_dword(0x4),
+                         sid)
+        g_ace_summaries.insert(key, ret)
+        return ret
+
 
 class StandardACE(ACE, Nestable):
     def __init__(self, buf, offset, parent):
@@ -257,8 +319,19 @@ class ObjectACE(ACE, Nestable):
         self.declare_field("word", "size", 0x2)
         self.declare_field("dword", "access_mask")
         self.declare_field("dword", "object_flags")
-        self.declare_field("guid", "object_type")
-        self.declare_field("guid", "inherited_object_type")
+        # each GUID is present only if its flag is set, and the SID follows
+        #   them. An absent GUID is declared with no instances, so that its
+        #   accessor returns None.
+        flags = self.object_flags()
+        if flags & OBJECT_ACE_FLAGS.ACE_OBJECT_TYPE_PRESENT:
+            self.declare_field("guid", "object_type")
+        else:
+            self.declare_field("guid", "object_type", count=0)
+        if flags & OBJECT_ACE_FLAGS.ACE_INHERITED_OBJECT_TYPE_PRESENT:
+            self.declare_field("guid", "inherited_object_type")
+        else:
+            self.declare_field("guid", "inherited_object_type", count=0)
+        self.declare_field(SID, "sid")
 
     @staticmethod
     def structure_size(buf, offset, parent):
@@ -424,18 +497,36 @@ class SDS_ENTRY(Block, Nestable):
         return self.length()
 
 
+# the header of an SDS_ENTRY: hash, security ID, offset, and length
+SDS_ENTRY_HEADER_STRUCT = struct.Struct("<IIQI")
+
+# $SDS is stored in blocks of this size, each followed by a mirror copy
+SDS_BLOCK_SIZE = 0x40000
+
+
 class SDS(Block):
     def __init__(self, buf, offset, parent):
         super(SDS, self).__init__(buf, offset)
         self.add_explicit_field(0, SDS, "sds_entries")
 
-    def sds_entries(self):
+    def entry_headers(self):
+        """
+        A generator that yields tuples (offset, hash, security ID, length)
+          for each SDS_ENTRY, without parsing the descriptors.
+        The mirror blocks are skipped.
+        """
+        buf = self._buf
         ofs = 0
-        while len(self._buf) > self.offset() + ofs + 0x14:
-            s = SDS_ENTRY(self._buf, self.offset() + ofs, self)
-            if len(s) != 0:
-                yield s
-                ofs += len(s)
+        while len(buf) > self.offset() + ofs + 0x14:
+            if (ofs // SDS_BLOCK_SIZE) % 2 == 1:
+                ofs = align(ofs + 1, SDS_BLOCK_SIZE)
+                continue
+
+            hash_, security_id, _, length = \
+                SDS_ENTRY_HEADER_STRUCT.unpack_from(buf, self.offset() + ofs)
+            if length != 0:
+                yield self.offset() + ofs, hash_, security_id, length
+                ofs += length
                 ofs = align(ofs, 0x10)
             else:
                 if ofs % 0x10000 == 0:
@@ -443,6 +534,165 @@ class SDS(Block):
                 else:
                     ofs = align(ofs, 0x10000)
 
+    def sds_entries(self):
+        """
+        A generator that yields each SDS_ENTRY, skipping the mirror blocks.
+        """
+        for offset, _, _, _ in self.entry_headers():
+            yield SDS_ENTRY(self._buf, offset, self)
+
+    def unique_entries(self):
+        """
+        A generator that yields the SDS_ENTRY of each distinct descriptor.
+        Entries are compared by their hash, and then by the bytes of
+          the descriptor, so copies of a descriptor are parsed only once.
+        """
+        buf = self._buf
+        seen = {}  # type: dict of int to list of (int, int)
+        for offset, hash_, _, length in self.entry_headers():
+            descriptor = buf[offset + 0x14:offset + length]
+            candidates = seen.setdefault(hash_, [])
+            if any(buf[o + 0x14:o + l] == descriptor for o, l in candidates):
+                continue
+            candidates.append((offset, length))
+            yield SDS_ENTRY(buf, offset, self)
+
+
+class SecureStore(object):
+    """
+    SecureStore resolves security IDs, such as those found in the
+      $STANDARD_INFORMATION attribute of MFT records, to the security
+      descriptors stored in the $Secure:$SDS stream.
+
+    The locations of the descriptors are read once from the $Secure:$SII
+      index, if it is provided, or otherwise from a single pass over
+      the entry headers in $SDS. After this, each lookup is a dictionary
+      access, and only the requested descriptor is parsed.
+    """
+    def __init__(self, sds_buf, sii_buf=None):
+        """
+        Constructor.
+        Arguments:
+        - `sds_buf`: Buffer containing the $Secure:$SDS stream.
+        - `sii_buf`: (Optional) Buffer containing the INDX records
+            of the $Secure:$SII index.
+        """
+        super(SecureStore, self).__init__()
+        self._sds_buf = sds_buf
+        self._sds = SDS(sds_buf, 0, None)
+        self._locations = {}  # type: dict of int to (int, int)
+        # there are few distinct descriptors, even on large volumes,
+        #  so these are not bounded.
+        self._descriptors = {}  # type: dict of int to SECURITY_DESCRIPTOR_RELATIVE
+        self._summaries = {}  # type: dict of int to dict
+        if sii_buf is not None:
+            self._load_sii(sii_buf)
+        else:
+            self._load_sds()
+
+    def _load_sii(self, sii_buf):
+        for offset, record in index_blocks(sii_buf):
+            if not record.has_valid_fixups():
+                logging.debug("Skipping $SII record at %s without fixups.", hex(offset))
+                continue
+            for e in record.node_header().entries(SII_INDEX_ENTRY):
+                self._locations[e.security_id()] = (e.descriptor_offset(),
+                                                    e.descriptor_length())
+
+    def _load_sds(self):
+        for ofs, _, security_id, length in self._sds.entry_headers():
+            # keep the first copy of each descriptor
+            if security_id not in self._locations:
+                self._locations[security_id] = (ofs, length)
+
+    def __len__(self):
+        return len(self._locations)
+
+    def __contains__(self, security_id):
+        return security_id in self._locations
+
+    def security_ids(self):
+        return self._locations.keys()
+
+    def get_entry(self, security_id):
+        """
+        Get the SDS_ENTRY for the given security ID.
+
+        @type security_id: int
+        @rtype: SDS_ENTRY
+        @raises KeyError: if the security ID is not found
+        """
+        offset, _ = self._locations[security_id]
+        return SDS_ENTRY(self._sds_buf, offset, self._sds)
+
+    def get_descriptor(self, security_id):
+        """
+        Get the security descriptor for the given security ID.
+
+        @type security_id: int
+        @rtype: SECURITY_DESCRIPTOR_RELATIVE
+        @raises KeyError: if the security ID is not found
+        """
+        try:
+            return self._descriptors[security_id]
+        except KeyError:
+            pass
+
+        offset, _ = self._locations[security_id]
+        descriptor = SECURITY_DESCRIPTOR_RELATIVE(self._sds_buf, offset + 0x14,
+                                                  self._sds)
+        self._descriptors[security_id] = descriptor
+        return descriptor
+
+    def summary(self, security_id):
+        """
+        Get a summary of the security descriptor for the given
+          security ID that is suitable for JSON or template output.
+        The descriptor is parsed only the first time its security
+          ID is requested.
+
+        The summary is a dict with the keys:
+          - security_id: int
+          - owner: string SID, or None
+          - group: string SID, or None
+          - dacl: list of ACESummary tuples (type, flags,
+              access_mask, sid), or None if there is no DACL.
+
+        @type security_id: int
+        @rtype: dict, or None if the descriptor cannot be found or parsed
+        """
+        try:
+            return self._summaries[security_id]
+        except KeyError:
+            pass
+
+        summary = None
+        if security_id in self._locations:
+            try:
+                summary = self._make_summary(security_id)
+            except ParseException as e:
+                logging.warning("Failed to parse security descriptor %d: %s",
+                                security_id, e)
+        self._summaries[security_id] = summary
+        return summary
+
+    def _make_summary(self, security_id):
+        descriptor = self.get_descriptor(security_id)
+        owner = descriptor.owner()
+        group = descriptor.group()
+        dacl = descriptor.dacl()
+
+        aces = None
+        if dacl is not None:
+            aces = [ace.summary() for ace in dacl.ACEs()]
+
+        return {
+            "security_id": security_id,
+            "owner": owner.string() if owner is not None else None,
+            "group": group.string() if group is not None else None,
+            "dacl": aces,
+        }
+
 
 def main():
     import sys
@@ -454,7 +704,7 @@ def main():
                                           access=mmap.ACCESS_READ)) as buf:
             s = SDS(buf, 0, None)
             print "SDS"
-            for e in s.sds_entries():
+            for e in s.unique_entries():
                 print("  SDS_ENTRY")
                 print(e.get_all_string(indent=2))
 
@@ -18,7 +18,7 @@
 #   limitations under the License.
 #
 #   Version v.1.2
-from SDS import SDS
+from SDS import SecureStore
 
 def main():
     import sys
@@ -26,23 +26,36 @@ def main():
     import contextlib
     import argparse
 
-    parser = argparse.ArgumentParser(description='Get an SDS record by index.')
+    parser = argparse.ArgumentParser(description='Get an SDS record by security ID.')
     parser.add_argument('-v', action="store_true", dest="verbose",
                         help="Print debugging information")
+    parser.add_argument('--sii', action="store", metavar="SII",
+                        help="Input $SII index file path, used to locate the "
+                        "record rather than scanning the SDS file")
     parser.add_argument('SDS', action="store",
                         help="Input SDS file path")
     parser.add_argument('index', action="store", type=int,
-                        help="Entry index to fetch")
+                        help="Security ID of the entry to fetch")
     results = parser.parse_args()
 
     with open(results.SDS, 'r') as f:
         with contextlib.closing(mmap.mmap(f.fileno(), 0,
                                           access=mmap.ACCESS_READ)) as buf:
-            s = SDS(buf, 0, None)
+            if results.sii:
+                with open(results.sii, 'r') as g:
+                    with contextlib.closing(mmap.mmap(g.fileno(), 0,
+                                                      access=mmap.ACCESS_READ)) as sii_buf:
+                        store = SecureStore(buf, sii_buf)
+            else:
+                store = SecureStore(buf)
+
+            if results.index not in store:
+                print "Security ID %d not found." % (results.index)
+                sys.exit(-1)
+
             print "SDS"
-            for e in s.sds_entries():
-                print("  SDS_ENTRY")
-                print(e.get_all_string(indent=2))
+            print("  SDS_ENTRY")
+            print(store.get_entry(results.index).get_all_string(indent=2))
 
 if __name__ == "__main__":
     main()
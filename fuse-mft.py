@@ -8,19 +8,46 @@ import stat
 import errno
 import inspect
 import calendar
+import threading
 
 from fuse import FUSE, FuseOSError, Operations, fuse_get_context
 
 from Progress import ProgressBarProgress
 from BinaryParser import Mmap
+from BinaryParser import read_byte
+from BinaryParser import read_word
+from FileMap import FileMap
+from FileMap import CompressedFile
+from FileMap import has_compression_magic
 from MFT import MFTTree
-from MFT import Cache
+from MFT import LazyMFTTree
+from MFT import new_record_cache
+from MFT import new_path_cache
 from MFT import MFTEnumerator
+from MFT import RunlistReader
+from MFT import Cache
+from MFT import ParseException
 from get_file_info import format_record
 
 
 PERMISSION_ALL_READ = int("444", 8)
 
+# number of getattr results and directory listings to cache
+STAT_CACHE_SIZE = 65536
+DIRENTS_CACHE_SIZE = 4096
+
+# the MFT is immutable, so the kernel may cache attributes
+#   and lookups for a long time, in seconds
+ATTR_TIMEOUT = 3600
+ENTRY_TIMEOUT = 3600
+
+# the block size and capacity of the cache over a volume image, in bytes
+VOLUME_BLOCK_SIZE = 64 * 1024
+VOLUME_CACHE_SIZE = 64 * 1024 * 1024
+
+# when set, each filesystem call is logged to STDERR by `log`
+DEBUG_LOG = False
+
 
 def unixtimestamp(ts):
     """
@@ -34,9 +61,13 @@ def unixtimestamp(ts):
 def log(func):
     """
     log is a decorator that logs the a function call with its
-      parameters and return value.
+      parameters and return value, if DEBUG_LOG is set.
+      Otherwise, the call is passed straight through, as inspecting
+      the stack on every call is expensive.
     """
     def inner(*args, **kwargs):
+        if not DEBUG_LOG:
+            return func(*args, **kwargs)
         func_name = inspect.stack()[3][3]
         if func_name == "_wrapper":
             func_name = inspect.stack()[2][3]
@@ -59,7 +90,7 @@ def log(func):
 class FH(object):
     """
     FH is a class used to represent a file handle.
-    Subclass it and override the get_data and get_size methods
+    Subclass it and override the read and get_size methods
       for specific behavior.
     """
     def __init__(self, fh, record):
@@ -67,12 +98,13 @@ class FH(object):
         self._fh = fh
         self._record = record
 
-    def get_data(self):
+    def read(self, offset, length):
         """
-        Return a bytestring containing the data of the opened file.
+        Return up to `length` bytes of the opened file,
+          starting at `offset`.
         @rtype: str
         """
-        raise RuntimeError("FH.get_data not implemented")
+        raise RuntimeError("FH.read not implemented")
 
     def get_size(self):
         """
@@ -86,27 +118,39 @@ class FH(object):
 
 class RegularFH(FH):
     """
-    RegularFH is a class used to represent an open file.
+    RegularFH is a class used to represent an open file, or one of
+      its alternate data streams.
+    Resident data is served from the MFT record. Non-resident data is
+      read through the runlist from `volume`, if one is provided,
+      and otherwise reads as empty.
     """
-    def __init__(self, fh, record):
+    def __init__(self, fh, record, volume=None, cluster_size=4096,
+                 volume_offset=0, stream=""):
         super(RegularFH, self).__init__(fh, record)
+        self._data = ""
+        self._reader = None
+        self._size = 0
+
+        data_attribute = record.data_attribute(stream)
+        if data_attribute is None:
+            self._size = record.filename_information().logical_size()
+        elif data_attribute.non_resident() == 0:
+            self._data = data_attribute.value()
+            self._size = len(self._data)
+        else:
+            self._size = data_attribute.data_size()
+            if volume is not None:
+                runs = data_attribute.runlist().runs(include_sparse=True)
+                self._reader = RunlistReader(volume, runs, self._size,
+                                             cluster_size, volume_offset)
 
-    def get_data(self):
-        data_attribute = self._record.data_attribute()
-        if data_attribute is not None and \
-           data_attribute.non_resident() == 0:
-                return data_attribute.value()
-        return ""
+    def read(self, offset, length):
+        if self._reader is not None:
+            return self._reader.read(offset, length)
+        return self._data[offset:offset + length]
 
     def get_size(self):
-        data_attribute = self._record.data_attribute()
-        if data_attribute is not None:
-            if data_attribute.non_resident() == 0:
-                return len(self.get_data())
-            else:
-                return data_attribute.data_size()
-        else:
-            return self._record.standard_information.logical_size()
+        return self._size
 
 
 def get_meta_for_file(record, path):
@@ -119,21 +163,167 @@ def get_meta_for_file(record, path):
     return format_record(record, path)
 
 
+def get_meta_data(record, path):
+    """
+    Render the metadata about a file as the UTF-8 bytes of
+      its virtual ::meta file.
+    @type record: MFT.MFTRecord
+    @type path: str
+    @rtype: str
+    """
+    return get_meta_for_file(record, path).encode("utf-8")
+
+
 class MetaFH(FH):
     """
     A class used to represent a virtual file containing metadata
-      for a regular file.
+      for a regular file. The metadata is rendered once, when
+      the file is opened.
     """
     def __init__(self, fh, record, path, record_buf):
         super(MetaFH, self).__init__(fh, record)
         self._path = path
         self._record_buf = record_buf
+        self._data = get_meta_data(record, path)
 
-    def get_data(self):
-        return get_meta_for_file(self._record, self._path)
+    def read(self, offset, length):
+        return self._data[offset:offset + length]
 
     def get_size(self):
-        return len(self.get_data())
+        return len(self._data)
+
+
+def record_stat(record, path=None, special=None, stream=""):
+    """
+    Compute the parts of the stat of a record, or of one of its
+      special files or alternate data streams, that do not depend
+      on the caller.
+    @type record: MFT.MFTRecord
+    @type path: str
+    @param path: The path of the record, needed for ::meta files.
+    @type special: str
+    @param special: The special file identifier, or None.
+    @type stream: str
+    @param stream: The name of an alternate data stream, or "".
+    @rtype: dict
+    @raises: FuseOSError(errno.ENOENT): if the stream does not exist.
+    """
+    if stream != "":
+        mode = (stat.S_IFREG | PERMISSION_ALL_READ)
+        nlink = 1
+    elif record.is_directory():
+        mode = (stat.S_IFDIR | PERMISSION_ALL_READ)
+        nlink = 2
+    else:
+        mode = (stat.S_IFREG | PERMISSION_ALL_READ)
+        nlink = 1
+
+    # TODO(wb): fix the duplication of this code with the FH classes
+    if special is not None:
+        size = 0
+        if special == "meta":
+            size = len(get_meta_data(record, path))
+    else:
+        data_attribute = record.data_attribute(stream)
+        if data_attribute is None and stream != "":
+            raise FuseOSError(errno.ENOENT)
+        if data_attribute is not None:
+            if data_attribute.non_resident() == 0:
+                size = len(data_attribute.value())
+            else:
+                size = data_attribute.data_size()
+        else:
+            size = record.filename_information().logical_size()
+
+    si = record.standard_information()
+    return {
+        "st_atime": unixtimestamp(si.accessed_time()),
+        "st_ctime": unixtimestamp(si.changed_time()),
+        #"st_crtime": unixtimestamp(si.created_time()),
+        "st_mtime": unixtimestamp(si.modified_time()),
+        "st_size": size,
+        "st_mode": mode,
+        "st_nlink": nlink,
+    }
+
+
+def new_stat_cache():
+    """
+    Create a cache of `record_stat` results, keyed by
+      (record number, stream name, special file identifier).
+    The stats of ::meta files are not cached, since their size
+      depends on the path through which the record is found.
+    """
+    return Cache(STAT_CACHE_SIZE, threadsafe=True)
+
+
+def precompute_stat(stat_cache, record):
+    """
+    Add the stat of a record to the cache, such as while
+      building the MFTTree.
+    """
+    try:
+        st = record_stat(record)
+    except (ParseException, AttributeError):
+        # no $STANDARD_INFORMATION or $FILE_NAME attribute;
+        #   let getattr report the error, if the file is ever used.
+        return
+    # keyed by the position of the record, as getattr looks it up,
+    #   rather than by the record number in its header
+    stat_cache.insert((record.inode, "", None), st)
+
+
+class HandleTable(object):
+    """
+    HandleTable allocates file handles and maps them to the FH objects
+      of open files. Released handles are reused from a free list,
+      so allocation takes constant time. It is safe to use from
+      multiple threads.
+    """
+    def __init__(self):
+        super(HandleTable, self).__init__()
+        self._lock = threading.Lock()
+        self._files = {}  # dict(int --> FH subclass)
+        self._free = []
+        self._next = 0
+
+    def allocate(self):
+        """
+        Reserve an unused handle.
+        @rtype: int
+        """
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            fh = self._next
+            self._next += 1
+            return fh
+
+    def set(self, fh, f):
+        """
+        Associate an allocated handle with an open file.
+        """
+        with self._lock:
+            self._files[fh] = f
+
+    def get(self, fh):
+        """
+        @rtype: FH
+        @raises KeyError: if the handle is not open.
+        """
+        return self._files[fh]
+
+    def release(self, fh):
+        """
+        Forget the file associated with the handle, if any,
+          and return the handle to the pool.
+        """
+        with self._lock:
+            self._files.pop(fh, None)
+            self._free.append(fh)
+
+    def __len__(self):
+        return len(self._files)
 
 
 def is_special_file(path):
@@ -156,18 +346,90 @@ def explode_special_file(path):
     return base, special
 
 
+def explode_stream(path):
+    """
+    explode_stream breaks apart the path of an alternate data stream,
+      like `dir/file:stream`, into its base path and stream name.
+    NTFS filenames cannot contain a colon, so the stream name is
+      everything after the first colon of the final component.
+    @type path: str
+    @rtype: (str, str)
+    @return: The base path and stream name, which is "" for the
+      default data stream.
+    """
+    (parent, sep, filename) = path.rpartition("/")
+    (filename, _, stream) = filename.partition(":")
+    return parent + sep + filename, stream
+
+
+def open_image(filename):
+    """
+    Open a raw image, or a gzip or bz2 compressed image, for reading.
+    A compressed image is read through a CompressedFile, whose seek
+      index is saved next to the image, so that only the first mount
+      must decompress the whole image to find its size.
+    zlib streams are not detected, since their two byte header is
+      too easily matched by the start of a raw image.
+    @type filename: str
+    @rtype: file-like object
+    """
+    f = open(filename, "rb")
+    magic = f.read(3)
+    for compression in ("gzip", "bz2"):
+        if has_compression_magic(compression, magic):
+            return CompressedFile(f, compression)
+    f.seek(0)
+    return f
+
+
+def read_cluster_size(volume, offset=0):
+    """
+    Read the cluster size of an NTFS volume from its boot sector.
+    @type volume: buffer
+    @type offset: int
+    @param offset: The offset of the volume within `volume`.
+    @rtype: int
+    @raises ValueError: if there is no NTFS boot sector at the offset.
+    """
+    if volume[offset + 3:offset + 11] != "NTFS    ":
+        raise ValueError("No NTFS boot sector at offset %s" % hex(offset))
+    bytes_per_sector = read_word(volume, offset + 0x0B)
+    sectors_per_cluster = read_byte(volume, offset + 0x0D)
+    if sectors_per_cluster > 0x80:
+        # large clusters are stored as a negative power of two
+        sectors_per_cluster = 1 << (256 - sectors_per_cluster)
+    return bytes_per_sector * sectors_per_cluster
+
+
 class MFTFuseOperations(Operations):
     """
     MFTFuseOperations is a FUSE driver for NTFS MFT files.
+    Its caches and handle table are thread-safe, so it may be
+      served by a multithreaded FUSE loop.
+
+    If a `volume` is provided, then non-resident data is read from
+      the volume found at `volume_offset`. Alternate data streams are
+      listed alongside their files as `file:stream`.
     """
-    def __init__(self, root, mfttree, buf):
+    def __init__(self, root, mfttree, buf, volume=None, cluster_size=4096,
+                 stat_cache=None, record_cache=None, path_cache=None,
+                 volume_offset=0):
         self._root = root
         self._tree = mfttree
         self._buf = buf
-        self._opened_files = {}  # dict(int --> FH subclass)
-
-        record_cache = Cache(1024)
-        path_cache = Cache(1024)
+        if stat_cache is None:
+            stat_cache = new_stat_cache()
+        self._stat_cache = stat_cache
+        self._dirents_cache = Cache(DIRENTS_CACHE_SIZE, threadsafe=True)
+        self._volume = volume
+        self._cluster_size = cluster_size
+        self._volume_offset = volume_offset
+        self._handles = HandleTable()
+
+        if record_cache is None:
+            record_cache = new_record_cache(threadsafe=True)
+        if path_cache is None:
+            path_cache = new_path_cache(threadsafe=True)
 
         self._enumerator = MFTEnumerator(buf,
                              record_cache=record_cache,
@@ -204,6 +466,22 @@ class MFTFuseOperations(Operations):
         """
         return self._enumerator.get_record(self._get_node(path).get_record_number())
 
+    def _list_directory(self, node):
+        """
+        _list_directory returns the entries of a directory, including
+          the alternate data streams of its children.
+        @type node: MFT.MFTTreeNode
+        @rtype: list of str
+        """
+        ret = ['.', '..']
+        for child in node.get_children_nodes():
+            filename = child.get_filename()
+            ret.append(filename)
+            record = self._enumerator.get_record(child.get_record_number())
+            for stream in record.data_stream_names():
+                ret.append(filename + ":" + stream)
+        return ret
+
     # Filesystem methods
     # ==================
     @log
@@ -211,53 +489,33 @@ class MFTFuseOperations(Operations):
         (uid, gid, pid) = fuse_get_context()
 
         working_path = path
-
+        special = None
         if is_special_file(path):
             (working_path, special) = explode_special_file(working_path)
-
-        record = self._get_record(working_path)
-        if record.is_directory():
-            mode = (stat.S_IFDIR | PERMISSION_ALL_READ)
-            nlink = 2
+        (working_path, stream) = explode_stream(working_path)
+        if stream != "" and special is not None:
+            raise FuseOSError(errno.ENOENT)
+
+        node = self._get_node(working_path)
+        record_number = node.get_record_number()
+        if special == "meta":
+            st = record_stat(self._enumerator.get_record(record_number),
+                             working_path, special, stream)
         else:
-            mode = (stat.S_IFREG | PERMISSION_ALL_READ)
-            nlink = 1
+            st = self._stat_cache.get_or_load((record_number, stream, special),
+                                              lambda: record_stat(self._enumerator.get_record(record_number),
+                                                                  working_path, special, stream))
 
-        # TODO(wb): fix the duplication of this code with the FH classes
-        if is_special_file(path):
-            size = 0
-            (working_path, special) = explode_special_file(path)
-            if special == "meta":
-                node = self._get_node(working_path)
-                record_buf = self._enumerator.get_record_buf(node.get_record_number())
-                size = len(get_meta_for_file(record, working_path))
-        else:
-            data_attribute = record.data_attribute()
-            if data_attribute is not None:
-                if data_attribute.non_resident() == 0:
-                    size = len(data_attribute.value())
-                else:
-                    size = data_attribute.data_size()
-            else:
-                size = record.filename_information().logical_size()
-
-        return {
-            "st_atime": unixtimestamp(record.standard_information().accessed_time()),
-            "st_ctime": unixtimestamp(record.standard_information().changed_time()),
-            #"st_crtime": unixtimestamp(record.standard_information().created_time()),
-            "st_mtime": unixtimestamp(record.standard_information().modified_time()),
-            "st_size": size,
-            "st_uid": uid,
-            "st_gid": gid,
-            "st_mode": mode,
-            "st_nlink": nlink,
-        }
+        ret = dict(st)
+        ret["st_uid"] = uid
+        ret["st_gid"] = gid
+        return ret
 
     @log
     def readdir(self, path, fh):
-        dirents = ['.', '..']
-        record = self._get_node(path)
-        dirents.extend(map(lambda r: r.get_filename(), record.get_children_nodes()))
+        node = self._get_node(path)
+        dirents = self._dirents_cache.get_or_load(node.get_record_number(),
+                                                  lambda: self._list_directory(node))
         for r in dirents:
             yield r
 
@@ -315,16 +573,6 @@ class MFTFuseOperations(Operations):
     # File methods
     # ============
 
-    def _get_available_fh(self):
-        """
-        _get_available_fh returns an unused fh
-        The caller must be careful to handle race conditions.
-        @rtype: int
-        """
-        for i in xrange(65534):
-            if i not in self._opened_files:
-                return i
-
     @log
     def open(self, path, flags):
         if flags & os.O_WRONLY > 0:
@@ -332,26 +580,34 @@ class MFTFuseOperations(Operations):
         if flags & os.O_RDWR > 0:
             return errno.EROFS
 
-        # TODO(wb): race here on fh used/unused
-        fh = self._get_available_fh()
-        if is_special_file(path):
-            (path, special) = explode_special_file(path)
-            if special == "meta":
-                record = self._get_record(path)
-                node = self._get_node(path)
-                record_buf = self._enumerator.get_record_buf(node.get_record_number())
-                self._opened_files[fh] = MetaFH(fh, record, path, record_buf)
+        fh = self._handles.allocate()
+        try:
+            if is_special_file(path):
+                (path, special) = explode_special_file(path)
+                if special == "meta":
+                    record = self._get_record(path)
+                    node = self._get_node(path)
+                    record_buf = self._enumerator.get_record_buf(node.get_record_number())
+                    self._handles.set(fh, MetaFH(fh, record, path, record_buf))
+                else:
+                    raise FuseOSError(errno.ENOENT)
             else:
-                raise FuseOSError(errno.ENOENT)
-        else:
-            self._opened_files[fh] = RegularFH(fh, self._get_record(path))
+                (path, stream) = explode_stream(path)
+                record = self._get_record(path)
+                if stream != "" and record.data_attribute(stream) is None:
+                    raise FuseOSError(errno.ENOENT)
+                self._handles.set(fh, RegularFH(fh, record,
+                                                self._volume, self._cluster_size,
+                                                self._volume_offset, stream))
+        except:
+            self._handles.release(fh)
+            raise
 
         return fh
 
     @log
     def read(self, path, length, offset, fh):
-        txt = self._opened_files[fh].get_data().encode("utf-8")
-        return txt[offset:offset+length]
+        return self._handles.get(fh).read(offset, length)
 
     @log
     def flush(self, path, fh):
@@ -359,7 +615,7 @@ class MFTFuseOperations(Operations):
 
     @log
     def release(self, path, fh):
-        del self._opened_files[fh]
+        self._handles.release(fh)
 
     @log
     def create(self, path, mode, fi=None):
@@ -378,12 +634,65 @@ class MFTFuseOperations(Operations):
         return errno.EPERM
 
 
-def main(mft_filename, mountpoint):
-    with Mmap(mft_filename) as buf:
-        tree = MFTTree(buf)
-        tree.build(progress_class=ProgressBarProgress)
-        handler = MFTFuseOperations(mountpoint, tree, buf)
-        FUSE(handler, mountpoint, foreground=True)
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Mount an MFT as a read-only filesystem.')
+    parser.add_argument('--lazy', action="store_true", dest="lazy",
+                        help="Mount immediately, and find the entries of "
+                        "each directory when it is first listed, rather "
+                        "than building the whole tree up front")
+    parser.add_argument('--threads', action="store_true", dest="threads",
+                        help="Serve concurrent requests from multiple threads")
+    parser.add_argument('--image', action="store", metavar="IMAGE",
+                        help="Raw image containing the volume, from which "
+                        "non-resident file data is read. It may be gzip "
+                        "or bz2 compressed")
+    parser.add_argument('--offset', action="store", type=int, default=0,
+                        dest="offset",
+                        help="Offset of the volume within the image, in bytes")
+    parser.add_argument('--debug', action="store_true", dest="debug",
+                        help="Log each filesystem call to STDERR")
+    parser.add_argument('filename', action="store",
+                        help="Input MFT file path")
+    parser.add_argument('mountpoint', action="store",
+                        help="Directory at which to mount the filesystem")
+    results = parser.parse_args()
+
+    global DEBUG_LOG
+    DEBUG_LOG = results.debug
+
+    volume = None
+    cluster_size = 4096
+    if results.image:
+        volume = FileMap(open_image(results.image),
+                         block_size=VOLUME_BLOCK_SIZE,
+                         cache_size=VOLUME_CACHE_SIZE,
+                         threadsafe=True)
+        cluster_size = read_cluster_size(volume, results.offset)
+
+    with Mmap(results.filename) as buf:
+        stat_cache = new_stat_cache()
+        # shared by the tree and the handler
+        record_cache = new_record_cache(threadsafe=True)
+        path_cache = new_path_cache(threadsafe=True)
+        if results.lazy:
+            tree = LazyMFTTree(buf, record_cache=record_cache,
+                               path_cache=path_cache)
+        else:
+            tree = MFTTree(buf)
+            tree.build(record_cache=record_cache, path_cache=path_cache,
+                       progress_class=ProgressBarProgress,
+                       callback=lambda record: precompute_stat(stat_cache, record))
+        handler = MFTFuseOperations(results.mountpoint, tree, buf,
+                                    stat_cache=stat_cache,
+                                    record_cache=record_cache,
+                                    path_cache=path_cache,
+                                    volume=volume,
+                                    cluster_size=cluster_size,
+                                    volume_offset=results.offset)
+        FUSE(handler, results.mountpoint, foreground=True,
+             nothreads=not results.threads,
+             attr_timeout=ATTR_TIMEOUT, entry_timeout=ENTRY_TIMEOUT)
 
 if __name__ == '__main__':
-    main(sys.argv[1], sys.argv[2])
+    main()
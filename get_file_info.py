@@ -2,16 +2,22 @@
 
 from MFT import MFTEnumerator
 
+import sys
 import array
 import re
 import logging
 import datetime
+from collections import Mapping
+from collections import OrderedDict
 
 import argparse
 from jinja2 import Template
 
 from BinaryParser import Mmap
-from MFT import Cache
+from MFT import parse_cache_size
+from MFT import new_record_cache
+from MFT import new_path_cache
+from MFT import DEFAULT_CACHE_SIZE
 from MFT import ATTR_TYPE
 from MFT import MREF
 from MFT import MSEQNO
@@ -197,66 +203,157 @@ def make_attribute_model(attr):
     return ret
 
 
-def make_model(record, path):
-    active_data = record.active_data()
-    slack_data = record.slack_data()
-    model = {
-        "magic": record.magic(),
-        "path": path,
-        "inode": record.inode,
-        "is_active": record.is_active(),
-        "is_directory": record.is_directory(),
-        "size": 0,  # updated below
-        "standard_information": make_standard_information_model(record.standard_information()),
-        "filename_information": make_filename_information_model(record.filename_information()),
-        "owner_id": 0,  # updated below
-        "security_id": 0,  # updated below
-        "quota_charged": 0,  # updated below
-        "usn": 0,  # updated below
-        "filenames": [],
-        "attributes": [],
-        "indx_entries": [],
-        "slack_indx_entries": [],
-        "timeline": get_timeline_entries(record),
-        "active_ascii_strings": ascii_strings(active_data),
-        "active_unicode_strings": unicode_strings(active_data),
-        "slack_ascii_strings": ascii_strings(slack_data),
-        "slack_unicode_strings": unicode_strings(slack_data),
-        }
-
-    if not record.is_directory():
-        data_attr = record.data_attribute()
-        if data_attr and data_attr.non_resident() > 0:
-            model["size"] = data_attr.data_size()
-        elif record.filename_information() is not None:
-            model["size"] = record.filename_information().logical_size()            
-        else:
-            model["size"] = 0
+def make_size_model(record):
+    if record.is_directory():
+        return 0
+    data_attr = record.data_attribute()
+    if data_attr and data_attr.non_resident() > 0:
+        return data_attr.data_size()
+    elif record.filename_information() is not None:
+        return record.filename_information().logical_size()
+    else:
+        return 0
+
 
+def make_filenames_model(record):
+    ret = []
     for b in record.attributes():
         if b.type() != ATTR_TYPE.FILENAME_INFORMATION:
             continue
         attr = FilenameAttribute(b.value(), 0, record)
-        model["filenames"].append(make_filename_information_model(attr))
+        ret.append(make_filename_information_model(attr))
+    return ret
 
-    for b in record.attributes():
-        model["attributes"].append(make_attribute_model(b))
 
+def make_indx_entries_model(record, slack=False):
+    ret = []
     indxroot = record.attribute(ATTR_TYPE.INDEX_ROOT)
     if indxroot and indxroot.non_resident() == 0:
         irh = IndexRootHeader(indxroot.value(), 0, False)
-        for e in irh.node_header().entries():
+        if slack:
+            entries = irh.node_header().slack_entries()
+        else:
+            entries = irh.node_header().entries()
+        for e in entries:
             m = make_filename_information_model(e.filename_information())
             m["inode"] = MREF(e.mft_reference())
             m["sequence_num"] = MSEQNO(e.mft_reference())
-            model["indx_entries"].append(m)
+            ret.append(m)
+    return ret
 
-        for e in irh.node_header().slack_entries():
-            m = make_filename_information_model(e.filename_information())
-            m["inode"] = MREF(e.mft_reference())
-            m["sequence_num"] = MSEQNO(e.mft_reference())
-            model["slack_indx_entries"].append(m)
-    return model
+
+def make_security_descriptor_model(record, security):
+    si = make_standard_information_model(record.standard_information())
+    if si is None or "security_id" not in si:
+        return None
+    summary = security.summary(si["security_id"])
+    if summary is None or summary["dacl"] is None:
+        return summary
+    # the ACE summaries are namedtuples, which JSON would encode as arrays
+    ret = dict(summary)
+    ret["dacl"] = [ace._asdict() for ace in summary["dacl"]]
+    return ret
+
+
+# the keys of a record model, and functions of
+#  (record, path, security) that compute their values
+RECORD_MODEL_FIELDS = OrderedDict([
+    ("magic", lambda r, p, s: r.magic()),
+    ("path", lambda r, p, s: p),
+    ("inode", lambda r, p, s: r.inode),
+    ("is_active", lambda r, p, s: r.is_active()),
+    ("is_directory", lambda r, p, s: r.is_directory()),
+    ("size", lambda r, p, s: make_size_model(r)),
+    ("standard_information", lambda r, p, s: make_standard_information_model(r.standard_information())),
+    ("filename_information", lambda r, p, s: make_filename_information_model(r.filename_information())),
+    ("owner_id", lambda r, p, s: 0),
+    ("security_id", lambda r, p, s: 0),
+    ("quota_charged", lambda r, p, s: 0),
+    ("usn", lambda r, p, s: 0),
+    ("filenames", lambda r, p, s: make_filenames_model(r)),
+    ("attributes", lambda r, p, s: [make_attribute_model(b) for b in r.attributes()]),
+    ("indx_entries", lambda r, p, s: make_indx_entries_model(r)),
+    ("slack_indx_entries", lambda r, p, s: make_indx_entries_model(r, slack=True)),
+    ("timeline", lambda r, p, s: get_timeline_entries(r)),
+    ("active_ascii_strings", lambda r, p, s: ascii_strings(r.active_data())),
+    ("active_unicode_strings", lambda r, p, s: unicode_strings(r.active_data())),
+    ("slack_ascii_strings", lambda r, p, s: ascii_strings(r.slack_data())),
+    ("slack_unicode_strings", lambda r, p, s: unicode_strings(r.slack_data())),
+    ("security_descriptor", lambda r, p, s: make_security_descriptor_model(r, s)),
+])
+
+
+class RecordModel(Mapping):
+    """
+    A read-only mapping that describes an MFT record, for templates
+      and JSON output. Each value is computed the first time its key
+      is accessed, so consumers that only need a few keys do not pay
+      for the expensive ones, such as the string scans.
+    """
+    def __init__(self, record, path, security=None):
+        """
+        Arguments:
+        - `record`: The MFTRecord.
+        - `path`: The string path of the record.
+        - `security`: (Optional) A SDS.SecureStore, used to add
+            a summary of the record's security descriptor as the
+            "security_descriptor" key.
+        """
+        super(RecordModel, self).__init__()
+        self._record = record
+        self._path = path
+        self._security = security
+        self._values = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+
+        if key == "security_descriptor" and self._security is None:
+            raise KeyError(key)
+        value = RECORD_MODEL_FIELDS[key](self._record, self._path, self._security)
+        self._values[key] = value
+        return value
+
+    def __iter__(self):
+        for key in RECORD_MODEL_FIELDS.iterkeys():
+            if key == "security_descriptor" and self._security is None:
+                continue
+            yield key
+
+    def __len__(self):
+        if self._security is None:
+            return len(RECORD_MODEL_FIELDS) - 1
+        return len(RECORD_MODEL_FIELDS)
+
+    def to_dict(self, fields=None):
+        """
+        Compute the model as a dict.
+
+        Arguments:
+        - `fields`: (Optional) The keys to include, rather than all of them.
+        @rtype: dict
+        @raise KeyError: if one of `fields` is not a key of the model.
+        """
+        if fields is None:
+            fields = self
+        return dict((key, self[key]) for key in fields)
+
+
+def make_model(record, path, security=None):
+    """
+    Create a lazy RecordModel of the given record.
+
+    Arguments:
+    - `record`: The MFTRecord.
+    - `path`: The string path of the record.
+    - `security`: (Optional) A SDS.SecureStore, used to add
+        a summary of the record's security descriptor as the
+        "security_descriptor" key.
+    """
+    return RecordModel(record, path, security)
 
 
 def format_record(record, path):
@@ -370,9 +467,16 @@ def print_indx_info(record, path):
 def main():
     parser = argparse.ArgumentParser(description='Inspect '
                                      'a given MFT file record.')
-    parser.add_argument('-a', action="store", metavar="cache_size", type=int,
-                        dest="cache_size", default=1024,
-                        help="Size of cache.")
+    parser.add_argument('-a', action="store", metavar="cache_size",
+                        type=parse_cache_size, dest="cache_size",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="Size of each of the record and path caches, "
+                        "in bytes, with a K, M, or G suffix (default: 16M). "
+                        "Unsuffixed values below 65536 are read as a number "
+                        "of records, as in older versions")
+    parser.add_argument('--cache-stats', action="store_true",
+                        dest="cache_stats",
+                        help="Print cache statistics to STDERR at exit")
     parser.add_argument('-p', action="store", metavar="prefix",
                         nargs=1, dest="prefix", default="\\.",
                         help="Prefix paths with `prefix` rather than \\.\\")
@@ -389,8 +493,8 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
 
     with Mmap(results.mft) as buf:
-        record_cache = Cache(results.cache_size)
-        path_cache = Cache(results.cache_size)
+        record_cache = new_record_cache(results.cache_size)
+        path_cache = new_path_cache(results.cache_size)
 
         enum = MFTEnumerator(buf,
                              record_cache=record_cache,
@@ -412,5 +516,9 @@ def main():
             record = enum.get_record_by_path(path)
             print_indx_info(record, results.prefix + path)
 
+        if results.cache_stats:
+            sys.stderr.write(record_cache.format_stats("record") + "\n")
+            sys.stderr.write(path_cache.format_stats("path") + "\n")
+
 if __name__ == "__main__":
     main()
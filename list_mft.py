@@ -34,20 +34,30 @@ import logging
 import calendar
 import json
 import datetime
+import contextlib
 
+from jinja2 import meta
+from jinja2 import nodes
 from jinja2 import Environment
 import argparse
 
 from BinaryParser import Mmap
-from MFT import Cache
+from MFT import parse_cache_size
+from MFT import new_record_cache
+from MFT import new_path_cache
+from MFT import DEFAULT_CACHE_SIZE
 from MFT import MFTEnumerator
 from MFT import ATTR_TYPE
 from MFT import MREF
 from MFT import IndexRootHeader
 from MFT import StandardInformationFieldDoesNotExist
+from SDS import SecureStore
 from get_file_info import make_model
+from get_file_info import RECORD_MODEL_FIELDS
 from Progress import NullProgress
 from Progress import ProgressBarProgress
+from Output import add_output_arguments
+from Output import open_output_from_args
 
 
 def format_bodyfile(path, size, inode, owner_id, info, attributes=None):
@@ -81,12 +91,15 @@ def format_bodyfile(path, size, inode, owner_id, info, attributes=None):
                                                  changed, created)
 
 
-def output_mft_record(mft_enumerator, record, prefix):
+def output_mft_record(mft_enumerator, record, prefix, output):
     """
-    Print to STDOUT all the Bodyfile formatted lines
+    Write to the output all the Bodyfile formatted lines
       associated with a single record. This includes
       a line for standard information, filename information,
       and any resident directory index entries.
+
+    Arguments:
+    - `output`: The Output.OutputSink to which to write.
     """
     tags = []
     if not record.is_active():
@@ -148,45 +161,42 @@ def output_mft_record(mft_enumerator, record, prefix):
 
     # si
     if si:
-        try:
-            print format_bodyfile(path, size, inode, si_index, si, tags),
-        except UnicodeEncodeError:
-            print "# failed to print: %s" % (list(path))
+        output.write(format_bodyfile(path, size, inode, si_index, si, tags))
 
     # fn
     if fn:
         tags = ["filename"]
         if not record.is_active():
             tags.append("inactive")
-        try:
-            print format_bodyfile(path, size, inode, si_index, fn, tags),
-        except UnicodeEncodeError:
-            print "# failed to print: %s" % (list(path))
+        output.write(format_bodyfile(path, size, inode, si_index, fn, tags))
 
     # ADS
     for ads in ADSs:
         tags = []
         if not record.is_active():
             tags.append("inactive")
-        try:
-            print format_bodyfile(path + ":" + ads[0], ads[1], inode, si_index, si or {}, tags),
-        except UnicodeEncodeError:
-            print "# failed to print: %s" % (list(path))
+        output.write(format_bodyfile(path + ":" + ads[0], ads[1], inode, si_index, si or {}, tags))
 
     # INDX
     for indx in indices:
         tags = ["indx"]
-        try:
-            print format_bodyfile(path + "\\" + indx[0], indx[1], MREF(indx[2]), 0, indx[3], tags),
-        except UnicodeEncodeError:
-            print "# failed to print: %s" % (list(path))
+        output.write(format_bodyfile(path + "\\" + indx[0], indx[1], MREF(indx[2]), 0, indx[3], tags))
 
     for indx in slack_indices:
         tags = ["indx", "slack"]
-        try:
-            print format_bodyfile(path + "\\" + indx[0], indx[1], MREF(indx[2]), 0, indx[3], tags),
-        except UnicodeEncodeError:
-            print "# failed to print: %s" % (list(path))
+        output.write(format_bodyfile(path + "\\" + indx[0], indx[1], MREF(indx[2]), 0, indx[3], tags))
+
+
+@contextlib.contextmanager
+def optional_mmap(filename):
+    """
+    Like BinaryParser.Mmap, but yields None if no filename is given.
+    """
+    if filename is None:
+        yield None
+    else:
+        with Mmap(filename) as buf:
+            yield buf
 
 
 def unixtimestampformat(value):
@@ -199,6 +209,59 @@ def unixtimestampformat(value):
     return int(calendar.timegm(value.timetuple()))
 
 
+def json_default(obj):
+    """
+    Serialize the values of a record model that the json module
+      does not handle itself.
+    """
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat("T") + "Z"
+    elif isinstance(obj, types.GeneratorType):
+        return [o for o in obj]
+    raise TypeError(repr(obj) + " is not JSON serializable")
+
+
+# built once, rather than per record. The compact encoder is also
+#  eligible for the C accelerated encoding loop, unlike an indenting one.
+JSON_ENCODER = json.JSONEncoder(indent=2, default=json_default)
+NDJSON_ENCODER = json.JSONEncoder(separators=(",", ":"), default=json_default)
+
+# number of records formatted by each rendering of a --format template
+RENDER_BATCH_SIZE = 256
+
+
+def get_batch_template(env, source):
+    """
+    Return a Jinja2 Template that renders the given template source
+      for each item of the `records` sequence in its context, with
+      each result followed by a newline. One call to `render` then
+      formats many records, rather than setting up a context per record.
+      The output is the same as rendering the source once per record.
+
+    Returns None if the source cannot be wrapped in a loop, such as
+      if it extends another template or defines blocks, which do not
+      see the loop variable, or if it refers to the `loop` or `records`
+      variables, which the wrapper would define.
+    """
+    ast = env.parse(source)
+    if ast.find(nodes.Extends) is not None or ast.find(nodes.Block) is not None:
+        return None
+    if meta.find_undeclared_variables(ast) & set(["loop", "records"]):
+        return None
+
+    # Jinja2 drops a single trailing newline from a template
+    for newline in ("\r\n", "\r", "\n"):
+        if source.endswith(newline):
+            source = source[:-len(newline)]
+            break
+
+    # the newline after the opening tag is removed by trim_blocks,
+    #  so that the source starts on its own line, as it would alone.
+    return env.from_string("{% for record in records %}\n" +
+                           source +
+                           "{{ \"\\n\" }}{% endfor %}")
+
+
 def get_default_template(env):
     """
     Return a Jinja2 Template instance that formats an
@@ -226,9 +289,16 @@ def get_default_template(env):
 def main():
     parser = argparse.ArgumentParser(description='Parse MFT '
                                      'filesystem structures.')
-    parser.add_argument('-c', action="store", metavar="cache_size", type=int,
-                        dest="cache_size", default=1024,
-                        help="Size of cache.")
+    parser.add_argument('-c', action="store", metavar="cache_size",
+                        type=parse_cache_size, dest="cache_size",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="Size of each of the record and path caches, "
+                        "in bytes, with a K, M, or G suffix (default: 16M). "
+                        "Unsuffixed values below 65536 are read as a number "
+                        "of records, as in older versions")
+    parser.add_argument('--cache-stats', action="store_true",
+                        dest="cache_stats",
+                        help="Print cache statistics to STDERR at exit")
     parser.add_argument('-p', action="store", metavar="prefix",
                         nargs=1, dest="prefix", default="\\.",
                         help="Prefix paths with `prefix` rather than \\.\\")
@@ -246,10 +316,28 @@ def main():
                         help="File containing output format specification")
     parser.add_argument('--json', action="store_true", dest="json",
                         help="Output in JSON format")
+    parser.add_argument('--ndjson', action="store_true", dest="ndjson",
+                        help="Output in newline delimited JSON format, "
+                        "with one compact object per line")
+    parser.add_argument('--fields', action="store", metavar="fields",
+                        dest="fields",
+                        help="Comma separated list of the record model keys "
+                        "to include in --json and --ndjson output, such as "
+                        "path,inode,standard_information (default: all)")
+    parser.add_argument('--sds', action="store", metavar="sds",
+                        dest="sds",
+                        help="$Secure:$SDS file path, used to add the "
+                        "owner, group and DACL of each record to the "
+                        "--json, --ndjson, and --format output")
+    parser.add_argument('--sii', action="store", metavar="sii",
+                        dest="sii",
+                        help="$Secure:$SII index file path, used with --sds "
+                        "to locate security descriptors")
     parser.add_argument('-f', action="store", metavar="regex",
                         nargs=1, dest="filter",
                         help="Only consider entries whose path "
                         "matches this regular expression")
+    add_output_arguments(parser)
     parser.add_argument('filename', action="store",
                         help="Input MFT file path")
     results = parser.parse_args()
@@ -264,33 +352,66 @@ def main():
     flags_count = 0
     if results.format:
         flags_count += 1
-        template = env.from_string(results.format[0])
+        source = results.format[0]
+        template = env.from_string(source)
     if results.format_file:
         flags_count += 1
         with open(results.format_file[0], "rb") as f:
-            template = env.from_string(f.read())
+            source = f.read()
+            template = env.from_string(source)
     if results.json:
         flags_count += 1
         pass
+    if results.ndjson:
+        flags_count += 1
+        pass
 
     if flags_count > 1:
-        sys.stderr.write("Only one of --format, --format_file, --json may be provided.\n")
+        sys.stderr.write("Only one of --format, --format_file, --json, --ndjson may be provided.\n")
         sys.exit(-1)
     elif flags_count == 1:
         use_default_output = False
     elif flags_count == 0:
+        # format_bodyfile() is used rather than the equivalent template
         flags_count += 1
-        template = get_default_template(env)
         use_default_output = True
 
+    fields = None
+    if results.fields:
+        fields = [f.strip() for f in results.fields.split(",") if f.strip()]
+        unknown = [f for f in fields if f not in RECORD_MODEL_FIELDS]
+        if unknown:
+            sys.stderr.write("Unknown --fields: %s. Choose from: %s\n" %
+                             (", ".join(unknown), ", ".join(RECORD_MODEL_FIELDS.keys())))
+            sys.exit(-1)
+        if "security_descriptor" in fields and not results.sds:
+            sys.stderr.write("--fields security_descriptor requires --sds.\n")
+            sys.exit(-1)
+
+    if results.sii and not results.sds:
+        sys.stderr.write("--sii requires --sds.\n")
+        sys.exit(-1)
+
+    if results.sds and use_default_output:
+        sys.stderr.write("--sds requires --json, --ndjson, --format, or --format_file.\n")
+        sys.exit(-1)
+
     if results.progress:
         progress_cls = ProgressBarProgress
     else:
         progress_cls = NullProgress
 
-    with Mmap(results.filename) as buf:
-        record_cache = Cache(results.cache_size)
-        path_cache = Cache(results.cache_size)
+    # the output is only created, or truncated, once the inputs are open
+    with contextlib.nested(Mmap(results.filename),
+                           optional_mmap(results.sds),
+                           optional_mmap(results.sii)) as (buf, sds_buf, sii_buf), \
+         open_output_from_args(results) as output:
+        security = None
+        if sds_buf is not None:
+            security = SecureStore(sds_buf, sii_buf)
+
+        record_cache = new_record_cache(results.cache_size)
+        path_cache = new_path_cache(results.cache_size)
 
         enum = MFTEnumerator(buf,
                              record_cache=record_cache,
@@ -298,29 +419,48 @@ def main():
         progress = progress_cls(enum.len())
         if use_default_output:
             for record, record_path in enum.enumerate_paths():
-                output_mft_record(enum, record, results.prefix[0])
+                output_mft_record(enum, record, results.prefix[0], output)
                 progress.set_current(record.inode)
         elif results.json:
-            class MFTEncoder(json.JSONEncoder):
-                def default(self, obj):
-                    if isinstance(obj, datetime.datetime):
-                        return obj.isoformat("T") + "Z"
-                    elif isinstance(obj, types.GeneratorType):
-                        return [o for o in obj]
-                    return json.JSONEncoder.default(self, obj)
-            print("[")
+            output.write("[\n")
+            separator = ""
             for record, record_path in enum.enumerate_paths():
-                m = make_model(record, record_path)
-                print(json.dumps(m, cls=MFTEncoder, indent=2) + ",")
+                m = make_model(record, record_path, security).to_dict(fields)
+                output.write(separator + JSON_ENCODER.encode(m))
+                separator = ",\n"
                 progress.set_current(record.inode)
-            print("]")
-        else:
+            output.write("\n]\n")
+        elif results.ndjson:
+            encode = NDJSON_ENCODER.encode
             for record, record_path in enum.enumerate_paths():
-                sys.stdout.write(template.render(record=make_model(record, record_path),
-                                                 prefix=results.prefix[0]) + "\n")
+                m = make_model(record, record_path, security).to_dict(fields)
+                output.write_line(encode(m))
                 progress.set_current(record.inode)
+        else:
+            batch_template = get_batch_template(env, source)
+            if batch_template is None:
+                for record, record_path in enum.enumerate_paths():
+                    output.write_line(template.render(record=make_model(record, record_path, security),
+                                                      prefix=results.prefix[0]))
+                    progress.set_current(record.inode)
+            else:
+                models = []
+                for record, record_path in enum.enumerate_paths():
+                    models.append(make_model(record, record_path, security))
+                    if len(models) >= RENDER_BATCH_SIZE:
+                        output.write(batch_template.render(records=models,
+                                                           prefix=results.prefix[0]))
+                        models = []
+                    progress.set_current(record.inode)
+                if models:
+                    output.write(batch_template.render(records=models,
+                                                       prefix=results.prefix[0]))
         progress.set_complete()
 
+        if results.cache_stats:
+            sys.stderr.write(record_cache.format_stats("record") + "\n")
+            sys.stderr.write(path_cache.format_stats("path") + "\n")
+
 
 if __name__ == "__main__":
     main()
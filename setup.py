@@ -17,6 +17,7 @@ setup(name='INDXParse',
         'SortedCollection',
         'SDS',
         'Progress',
+        'Output',
     ],
     scripts=[
         'extract_mft_record_slack.py',
@@ -2,6 +2,7 @@
 
 from MFT import MFTEnumerator
 
+import sys
 import mmap
 import logging
 import calendar
@@ -9,7 +10,10 @@ from datetime import datetime
 
 import argparse
 
-from MFT import Cache
+from MFT import parse_cache_size
+from MFT import new_record_cache
+from MFT import new_path_cache
+from MFT import DEFAULT_CACHE_SIZE
 from MFT import MFTTree
 
 
@@ -36,9 +40,16 @@ class Mmap(object):
 def main():
     parser = argparse.ArgumentParser(description='Parse MFT '
                                      'filesystem structures.')
-    parser.add_argument('-c', action="store", metavar="cache_size", type=int,
-                        dest="cache_size", default=1024,
-                        help="Size of cache.")
+    parser.add_argument('-c', action="store", metavar="cache_size",
+                        type=parse_cache_size, dest="cache_size",
+                        default=DEFAULT_CACHE_SIZE,
+                        help="Size of each of the record and path caches, "
+                        "in bytes, with a K, M, or G suffix (default: 16M). "
+                        "Unsuffixed values below 65536 are read as a number "
+                        "of records, as in older versions")
+    parser.add_argument('--cache-stats', action="store_true",
+                        dest="cache_stats",
+                        help="Print cache statistics to STDERR at exit")
     parser.add_argument('-v', action="store_true", dest="verbose",
                         help="Print debugging information")
     parser.add_argument('filename', action="store",
@@ -50,15 +61,18 @@ def main():
         logging.basicConfig(level=logging.DEBUG)
 
     with Mmap(results.filename) as buf:
-        record_cache = Cache(results.cache_size)
-        path_cache = Cache(results.cache_size)
+        record_cache = new_record_cache(results.cache_size)
+        path_cache = new_path_cache(results.cache_size)
         
         tree = MFTTree(buf)
         tree.build(record_cache=record_cache, path_cache=path_cache)
+        if results.cache_stats:
+            sys.stderr.write(record_cache.format_stats("record") + "\n")
+            sys.stderr.write(path_cache.format_stats("path") + "\n")
 
         def rec(node, prefix):
             print prefix + node.get_filename()
-            for child in node.get_children():
+            for child in node.get_children_nodes():
                 rec(child, prefix + "  ")
         
         rec(tree.get_root(), "")